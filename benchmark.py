@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import storage
+import storage_server
+import signing
+import database
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+import statistics
+
+# secret sizes in bytes and how often they occur, most entries are a
+# password with a few lines of notes, some have larger attachments
+SECRET_SIZES = ((16, 50), (200, 35), (2000, 12), (50000, 3))
+
+class _MemoryStorageProvider(storage.StorageProvider):
+    def __init__(self, input_type):
+        super(_MemoryStorageProvider, self).__init__(input_type)
+        self.value = None
+
+    def load(self):
+        return self.value
+
+    def store(self, obj):
+        self.value = obj
+
+def generate_vault(entries, seed=0):
+    """
+    Returns a vault dict in the layout Session stores.
+    """
+    rnd = random.Random(seed)
+    data_key = os.urandom(32)
+    sizes = [size for size, weight in SECRET_SIZES for _ in range(weight)]
+    passwords = {}
+    for i in range(entries):
+        name = "group%d/site%d.example.com" % (i % 50, i)
+        secret = storage.seal(data_key, os.urandom(rnd.choice(sizes)), name.encode("utf-8"))
+        passwords[name] = { "secret": base64.b64encode(secret).decode("ascii") }
+    return {
+        "version": 1,
+        "key": base64.b64encode(storage.seal(os.urandom(32), data_key)).decode("ascii"),
+        "passwords": passwords
+    }
+
+def _size(obj):
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    return len(json.dumps(obj))
+
+def _measure(fun, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def _peak_memory(fun):
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _result(stage, input_size, store_seconds, load_seconds, store_peak, load_peak, **extra):
+    result = {
+        "stage": stage,
+        "bytes": input_size,
+        "store_seconds": store_seconds,
+        "load_seconds": load_seconds,
+        "store_bytes_per_second": input_size / store_seconds if store_seconds else None,
+        "load_bytes_per_second": input_size / load_seconds if load_seconds else None,
+        "store_peak_memory": store_peak,
+        "load_peak_memory": load_peak,
+    }
+    result.update(extra)
+    return result
+
+def _bench_provider(stage, provider, obj, repeat, memory):
+    def store():
+        provider.store(obj)
+    store_seconds = _measure(store, repeat)
+    load_seconds = _measure(provider.load, repeat)
+    store_peak = _peak_memory(store) if memory else None
+    load_peak = _peak_memory(provider.load) if memory else None
+    return _result(stage, _size(obj), store_seconds, load_seconds, store_peak, load_peak)
+
+def _bench_remote(stage, provider, remote, obj, repeat, memory):
+    """
+    Like _bench_provider for a provider that reaches the server through
+    remote. remote skips storing the blob it last saw and loads it with
+    If-None-Match, so every store gets a new tail and every load forgets the
+    cached blob first. Loads answered with 304 are returned as a second
+    result.
+    """
+    def store():
+        provider.store(obj[:-16] + os.urandom(16))
+    def forget():
+        remote._etag = None
+        remote._cached = None
+    def load():
+        forget()
+        provider.load()
+    store_seconds = _measure(store, repeat)
+    load_seconds = _measure(provider.load, repeat, forget)
+    store_peak = _peak_memory(store) if memory else None
+    load_peak = _peak_memory(load) if memory else None
+    full = _result(stage, _size(obj), store_seconds, load_seconds, store_peak, load_peak)
+
+    provider.load()
+    cached_seconds = _measure(provider.load, repeat)
+    cached_peak = _peak_memory(provider.load) if memory else None
+    cached = _result(stage + " (304)", _size(obj), None, cached_seconds, None, cached_peak)
+    return full, cached
+
+def bench_stages(vault, keys, password, remote, directory, repeat, memory):
+    """
+    Measures every stage on its own, each storing into memory the input the
+    following stage would get. Returns the results in pipeline order.
+    """
+    results = []
+    obj = vault
+
+    def stage(name, make, input_type):
+        nonlocal obj
+        sink = _MemoryStorageProvider(input_type)
+        transformer = make(sink)
+        results.append(_bench_provider(name, transformer, obj, repeat, memory))
+        obj = sink.value
+        return transformer
+
+    stage("JsonStorageTransformer", storage.JsonStorageTransformer, str)
+    stage("StringEncoder", storage.StringEncoder, bytes)
+    gzip_input = obj
+    stage("GzipTransformer", storage.GzipTransformer, bytes)
+    obj = gzip_input
+    stage("CompressionTransformer", lambda nxt: storage.CompressionTransformer(nxt, policy="balanced"), bytes)
+    results[-1]["ratio"] = len(obj) / len(gzip_input)
+
+    holder = storage_server.RemoteStorageProvider("http://127.0.0.1:1")
+    holder.public_key, holder.private_key = keys
+    stage("KeyExchange", lambda nxt: storage_server.KeyExchange(nxt, holder), bytes)
+
+    # the key is cached after the first derivation, measure that separately
+    sink = _MemoryStorageProvider(bytes)
+    start = time.perf_counter()
+    storage.ScryptAESStorageTransformer(sink, password).store(obj)
+    kdf_seconds = time.perf_counter() - start
+    stage("ScryptAESStorageTransformer", lambda nxt: storage.ScryptAESStorageTransformer(nxt, password), bytes)
+    results[-1]["first_store_seconds"] = kdf_seconds
+
+    results.append(_bench_provider("FileStorageProvider", storage.FileStorageProvider(os.path.join(directory, "db")), obj, repeat, memory))
+    results.extend(_bench_remote("RemoteStorageProvider", remote, remote, obj, repeat, memory))
+    local = storage.LocalCopyStorageProvider(remote, storage.FileStorageProvider(os.path.join(directory, "db.copy")))
+    results.extend(_bench_remote("LocalCopyStorageProvider", local, remote, obj, repeat, memory))
+    return results
+
+def bench_pipeline(vault, keys, password, remote, directory, repeat, memory):
+    """
+    Measures the whole pipeline as built by config.build_storage_pipeline.
+    """
+    pipe = storage.LocalCopyStorageProvider(remote, storage.FileStorageProvider(os.path.join(directory, "pipeline.db")))
+    pipe = storage.ScryptAESStorageTransformer(pipe, password)
+    pipe = storage_server.KeyExchange(pipe, remote)
+    pipe = storage.CompressionTransformer(pipe, policy="balanced")
+    pipe = storage.StringEncoder(pipe)
+    pipe = storage.JsonStorageTransformer(pipe)
+    return _bench_provider("pipeline", pipe, vault, repeat, memory)
+
+def bench_database(entries, repeat):
+    """
+    Compares the memory and lookup times of database.Database with the
+    nested dicts of the stored vault layout.
+    """
+    names = ["group%d/site%d.example.com" % (i % 50, i) for i in range(entries)]
+    secrets = [base64.b64encode(os.urandom(45)).decode("ascii") for _ in range(entries)]
+    lookups = random.Random(0).sample(names, min(entries, 10000))
+
+    def size(build):
+        tracemalloc.start()
+        try:
+            obj = build()
+            return obj, tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    passwords, dict_bytes = size(lambda: { name: { "secret": secret } for name, secret in zip(names, secrets) })
+    db, db_bytes = size(lambda: database.Database(database.Login(name, secret) for name, secret in zip(names, secrets)))
+
+    def per_lookup(fun):
+        return _measure(lambda: [fun(name) for name in lookups], repeat) / len(lookups)
+
+    db.names()
+    return {
+        "entries": entries,
+        "dict_bytes": dict_bytes,
+        "database_bytes": db_bytes,
+        "dict_lookup_seconds": per_lookup(lambda name: passwords[name]["secret"]),
+        "database_lookup_seconds": per_lookup(lambda name: db.get(name).secret),
+        "dict_names_seconds": _measure(lambda: tuple(passwords.keys()), repeat),
+        "database_names_seconds": _measure(db.names, repeat),
+        "database_prefix_seconds": _measure(lambda: db.prefix("group7/site1"), repeat),
+        "database_copy_seconds": _measure(db.copy, repeat),
+    }
+
+def _start_server(data_file):
+    server = storage_server.make_server("127.0.0.1", 0, data_file)
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+def run(sizes, repeat, memory, database_entries=100000, password="benchmark"):
+    directory = tempfile.mkdtemp(prefix="password-benchmark-")
+    # one server for the single stages and one for the whole pipeline, so
+    # their remotes don't invalidate each other's versions
+    stage_server, stage_url = _start_server(os.path.join(directory, "server.db"))
+    pipeline_server, pipeline_url = _start_server(os.path.join(directory, "pipeline-server.db"))
+
+    # key generation is slow, use one key for everything
+    private_key = signing.PrivateKey.generate()
+    keys = private_key.public_key, private_key
+    remote = storage_server.RemoteStorageProvider(stage_url)
+    remote.public_key, remote.private_key = keys
+    pipeline_remote = storage_server.RemoteStorageProvider(pipeline_url, os.path.join(directory, "pipeline.remote"))
+    pipeline_remote.public_key, pipeline_remote.private_key = keys
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.time(),
+        "repeat": repeat,
+        "runs": [],
+    }
+    if database_entries:
+        print("Benchmarking a database of %d entries..." % database_entries, file=sys.stderr)
+        report["database"] = bench_database(database_entries, repeat)
+    try:
+        for entries in sizes:
+            print("Benchmarking %d entries..." % entries, file=sys.stderr)
+            vault = generate_vault(entries)
+            stages = bench_stages(vault, keys, password, remote, directory, repeat, memory)
+            pipeline = bench_pipeline(vault, keys, password, pipeline_remote, directory, repeat, memory)
+            report["runs"].append({ "entries": entries, "stages": stages, "pipeline": pipeline })
+    finally:
+        stage_server.shutdown()
+        pipeline_server.shutdown()
+    return report
+
+def print_table(report, out):
+    print("%8s %-32s %12s %10s %10s %12s" % ("entries", "stage", "bytes", "store ms", "load ms", "peak MiB"), file=out)
+    for run in report["runs"]:
+        for result in run["stages"] + [run["pipeline"]]:
+            peak = max(result["store_peak_memory"] or 0, result["load_peak_memory"] or 0) / (1 << 20)
+            # rows of loads answered with 304 have no store
+            store = "-" if result["store_seconds"] is None else "%.2f" % (result["store_seconds"] * 1000)
+            print("%8d %-32s %12d %10s %10.2f %12.1f" % (
+                run["entries"], result["stage"], result["bytes"],
+                store, result["load_seconds"] * 1000, peak), file=out)
+    db = report.get("database")
+    if db is not None:
+        print("", file=out)
+        print("%d entries: dicts %.1f MiB, Database %.1f MiB" % (
+            db["entries"], db["dict_bytes"] / (1 << 20), db["database_bytes"] / (1 << 20)), file=out)
+        print("lookup: dicts %.0f ns, Database %.0f ns; names: dicts %.2f ms, Database %.4f ms (cached); prefix %.4f ms; copy %.2f ms" % (
+            db["dict_lookup_seconds"] * 1e9, db["database_lookup_seconds"] * 1e9,
+            db["dict_names_seconds"] * 1000, db["database_names_seconds"] * 1000,
+            db["database_prefix_seconds"] * 1000, db["database_copy_seconds"] * 1000), file=out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the storage pipeline against a local storage server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000], dest="sizes")
+    parser.add_argument("--repeat", type=int, default=3, dest="repeat")
+    parser.add_argument("--no-memory", action="store_false", dest="memory", help="skip the (slow) peak memory runs")
+    parser.add_argument("--database-entries", type=int, default=100000, dest="database_entries",
+                        help="entries of the database.Database benchmark, 0 to skip it")
+    parser.add_argument("-o", "--output", dest="output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, args.memory, args.database_entries)
+    print_table(report, sys.stderr)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -3,14 +3,77 @@
 from storage import *
 import storage_server
 
-def build_storage_pipeline(password):
-    remote = storage_server.RemoteStorageProvider("http://pw.yawk.at")
+# keep a local journal of single entry changes instead of storing the whole
+# vault on every save, see JournalStorageProvider
+USE_JOURNAL = False
+
+# return the local copy on login and refresh it from the server in the
+# background, instead of waiting for the server
+REVALIDATE = True
+
+# how CompressionTransformer picks the codec, see CompressionTransformer.POLICIES
+COMPRESSION_POLICY = "balanced"
+
+# scrypt parameters are calibrated per host so deriving the key takes about
+# this long and uses at most this much memory, see calibrate_scrypt
+KDF_TARGET_SECONDS = 0.5
+KDF_MAX_MEMORY = 256 << 20
+KDF_PARAMETERS_FILE = "kdf.json"
+
+# storage server. A list of addresses is tried in order, e.g. the primary
+# followed by its replicas.
+REMOTE_ADDRESS = "http://pw.yawk.at"
+
+# whether the server keeps many vaults, each at /vault/<fingerprint of the
+# vault's public key>. A device that has not loaded the vault yet needs its
+# fingerprint in REMOTE_VAULT, init.py prints it.
+REMOTE_MULTI_VAULT = False
+REMOTE_VAULT = None
+
+# upstream part of the pipeline, set up by prefetch
+_prefetched = None
+
+def _build_upstream():
+    remote = storage_server.RemoteStorageProvider(REMOTE_ADDRESS, "db.remote", REMOTE_MULTI_VAULT, REMOTE_VAULT)
     local = FileStorageProvider("db")
+    queue = FileStorageProvider("db.pending")
+    return LocalCopyStorageProvider(remote, local, REVALIDATE, queue), remote
+
+def prefetch():
+    """
+    Prepares logging in before the password is known: calibrates the
+    scrypt parameters, which is the slow part on a new host, and sets up
+    the pipeline up to the server. With REVALIDATE, logging in returns the
+    local copy anyway, so the vault is only fetched if there is no local
+    copy yet or logging in would wait for the server.
+    """
+    global _prefetched
+    _prefetched = _build_upstream()
+    try:
+        if not REVALIDATE or not _prefetched[0].local.exists():
+            _prefetched[0].refresh()
+    finally:
+        # also when the server cannot be reached
+        _kdf_parameters()
+
+def _kdf_parameters():
+    return load_scrypt_parameters(KDF_PARAMETERS_FILE, KDF_TARGET_SECONDS, KDF_MAX_MEMORY)
+
+def build_storage_pipeline(password, listener=None):
+    global _prefetched
+    if _prefetched is not None:
+        (pipe, remote), _prefetched = _prefetched, None
+    else:
+        pipe, remote = _build_upstream()
+    pipe.listener = listener
 
-    pipe = LocalCopyStorageProvider(remote, local)
-    pipe = ScryptAESStorageTransformer(pipe, password)
+    pipe = aes = ScryptAESStorageTransformer(pipe, password)
+    # loads use the parameters of the stored blob, these apply from the next store
+    aes.set_parameters(*_kdf_parameters())
     pipe = storage_server.KeyExchange(pipe, remote)
-    pipe = GzipTransformer(pipe)
+    pipe = CompressionTransformer(pipe, policy=COMPRESSION_POLICY)
     pipe = StringEncoder(pipe)
     pipe = JsonStorageTransformer(pipe)
+    if USE_JOURNAL:
+        pipe = JournalStorageProvider(pipe, "db.journal", aes, listener=listener)
     return pipe
@@ -1,44 +1,99 @@
 #!/usr/bin/env python3
 
-from storage import *
+import bisect
 
-import threading
+class Login(object):
+    """
+    One vault entry. Logins are never changed, a change replaces the login.
+    """
 
-class Login:
-    def __init__(self, name, data):
+    __slots__ = ("name", "secret")
+
+    def __init__(self, name, secret):
         self.name = name
-        self.data = data
-
-    @property
-    def password(self):
-        return self.data.split("\n")[0]
-
-class Database:
-    def __init__(self, storage_provider):
-        self._data = { "logins": [] }
-        self._dirty = True
-        self._storage_provider = storage_provider
-        self._lock = threading.Lock()
-
-    def load(self):
-        with self._lock:
-            self.data = self._storage_provider.load()
-            self._dirty = False
-
-    def save(self):
-        if not self._dirty:
-            return
-        with self._lock:
-            if not self._dirty:
-                return
-            self._storage_provider.store(self.data)
-            self._dirty = False
-
-    @property
-    def logins(self):
-        for e in self._data["logins"]:
-            yield Login(e["name"], e["data"])
-
-    def add_login(self, login):
-        with self._lock:
-            self._data["logins"].append({ "name": login.name, "data": login.data })
+        self.secret = secret
+
+    def to_json(self):
+        return { "secret": self.secret }
+
+class Database(object):
+    """
+    The entries of a vault, indexed by name. The names are also kept
+    sorted for prefix and range queries, and the name tuples handed out are
+    cached until the next change.
+
+    A Database that was handed to other threads must not be changed, copy
+    it and change the copy instead.
+    """
+
+    def __init__(self, logins=()):
+        self._logins = {}
+        self._names = None
+        for login in logins:
+            self._logins[login.name] = login
+        self._sorted = sorted(self._logins)
+
+    @staticmethod
+    def from_json(passwords):
+        """
+        Builds a Database from the "passwords" object of a vault.
+        """
+        return Database(Login(name, entry["secret"]) for name, entry in passwords.items())
+
+    def to_json(self):
+        return { name: login.to_json() for name, login in self._logins.items() }
+
+    def copy(self):
+        db = Database()
+        db._logins = dict(self._logins)
+        db._sorted = list(self._sorted)
+        db._names = self._names
+        return db
+
+    def __len__(self):
+        return len(self._logins)
+
+    def __contains__(self, name):
+        return name in self._logins
+
+    def get(self, name):
+        """
+        Returns the login with the given name, None if there is none.
+        """
+        return self._logins.get(name)
+
+    def put(self, login):
+        if login.name not in self._logins:
+            bisect.insort(self._sorted, login.name)
+            self._names = None
+        self._logins[login.name] = login
+
+    def remove(self, name):
+        if self._logins.pop(name, None) is not None:
+            del self._sorted[bisect.bisect_left(self._sorted, name)]
+            self._names = None
+
+    def names(self):
+        """
+        Returns all names, sorted.
+        """
+        if self._names is None:
+            self._names = tuple(self._sorted)
+        return self._names
+
+    def range(self, start, end=None):
+        """
+        Returns the sorted names n with start <= n < end.
+        """
+        lo = bisect.bisect_left(self._sorted, start)
+        hi = len(self._sorted) if end is None else bisect.bisect_left(self._sorted, end, lo)
+        return tuple(self._sorted[lo:hi])
+
+    def prefix(self, prefix):
+        """
+        Returns the sorted names starting with prefix.
+        """
+        if not prefix:
+            return self.names()
+        # the first string after all strings starting with prefix
+        return self.range(prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
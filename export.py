@@ -9,4 +9,5 @@ password = getpass.getpass("Password: ")
 sess = session.Session()
 sess.log_in(password)
 
-print(json.dumps(sess.data))
+passwords = { name: { "password": sess.get_password(name) } for name in sess.list_password_names() }
+print(json.dumps({ "version": 0, "passwords": passwords }))
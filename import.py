@@ -9,6 +9,8 @@ password = getpass.getpass("Password: ")
 
 sess = session.Session()
 sess.log_in(password, load=False)
+sess.init_empty()
 with open(sys.argv[1]) as f:
-    sess.data = json.load(f)
+    data = json.load(f)
+sess.add_passwords(((name, entry["password"]) for name, entry in data["passwords"].items()), save=False)
 sess.save()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import session
+import storage_server
 import sys
 import argparse
 import getpass
@@ -25,7 +26,7 @@ sess.init_empty()
 
 def add(name, password):
     print("Adding %s..." % name)
-    if name in sess.list_password_names():
+    if name in sess.database:
         print("Duplicate name %s, merging" % name)
         password = sess.get_password(name) + "\n###\n" + password
     sess.add_password(name, password, save=False)
@@ -90,3 +91,8 @@ for keepass2file in args.keepass2:
     enter_group(tuple(), root)
 
 sess.save()
+
+remote = sess.pipeline.find(storage_server.RemoteStorageProvider)
+if remote.multi_vault:
+    print("Vault fingerprint: %s" % remote.public_key.fingerprint)
+    print("Set config.REMOTE_VAULT to it on other devices")
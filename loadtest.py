@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import storage_server
+import signing
+import os
+import io
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(directory, durability):
+    """
+    Starts storage_server.py in its own process, so it does not compete
+    with the clients for the GIL. Returns the process and its URL.
+    """
+    port = _free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage_server.py"),
+        "--address", "127.0.0.1", "-p", str(port),
+        "-f", os.path.join(directory, "db"), "--vault-dir", os.path.join(directory, "vaults"),
+        "--durability", durability,
+    ], stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, "http://127.0.0.1:%d" % port
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise OSError("Server did not start")
+            time.sleep(0.05)
+
+class _Client(object):
+    """
+    One simulated user with a vault of its own, stores and loads like
+    RemoteStorageProvider does.
+    """
+
+    def __init__(self, url, private_key, blob_size):
+        self.path = "/vault/" + private_key.public_key.fingerprint
+        self.transport = storage_server.HttpTransport(url, retries=0, failure_threshold=1 << 30)
+        self.etag = None
+        # signing is not what is measured, sign a few blobs up front
+        self.bodies = []
+        for _ in range(4):
+            blob = os.urandom(blob_size)
+            f = io.BytesIO()
+            storage_server._writeblock(f, private_key.public_key.save())
+            storage_server._writeblock(f, private_key.sign(blob))
+            storage_server._writeblock(f, blob)
+            self.bodies.append(f.getvalue())
+
+    def prepare(self):
+        # continue the vault of an earlier run, or create it
+        status, headers, _ = self.transport.request("GET", self.path)
+        if status == 200:
+            self.etag = headers.get("ETag")
+        else:
+            self.put()
+
+    def put(self):
+        headers = {}
+        if self.etag is not None:
+            headers["If-Match"] = self.etag
+        status, response_headers, _ = self.transport.request("PUT", self.path, random.choice(self.bodies), headers)
+        if status != 200:
+            raise storage_server.HttpError(status, "storing")
+        self.etag = response_headers.get("ETag")
+
+    def get(self):
+        status, _, _ = self.transport.request("GET", self.path)
+        if status != 200:
+            raise storage_server.HttpError(status, "loading")
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _summary(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "per_second": len(ordered) / seconds,
+        "p50": _percentile(ordered, 0.5),
+        "p95": _percentile(ordered, 0.95),
+        "p99": _percentile(ordered, 0.99),
+        "max": ordered[-1] if ordered else None,
+    }
+
+def run_step(clients, put_ratio, rate, duration):
+    """
+    Drives the clients for duration seconds, with rate operations per
+    second in total or as fast as possible if rate is 0. With a rate,
+    latency counts from when a request was due, so a saturated server
+    shows up in the latencies and not only in the throughput.
+    """
+    latencies = { "put": [], "get": [] }
+    errors = { "put": 0, "get": 0 }
+    lock = threading.Lock()
+    for client in clients:
+        client.prepare()
+    start = time.perf_counter()
+    end = start + duration
+
+    def drive(client, offset):
+        rnd = random.Random()
+        interval = len(clients) / rate if rate else 0
+        due = start + offset * interval
+        while True:
+            if rate:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                due = time.perf_counter()
+            if due >= end:
+                return
+            op = "put" if rnd.random() < put_ratio else "get"
+            try:
+                getattr(client, op)()
+                failed = False
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - due
+            with lock:
+                if failed:
+                    errors[op] += 1
+                else:
+                    latencies[op].append(elapsed)
+            due += interval
+
+    threads = [threading.Thread(target=drive, args=(client, i / len(clients))) for i, client in enumerate(clients)]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    seconds = time.perf_counter() - start
+    return {
+        "clients": len(clients),
+        "seconds": seconds,
+        "total": _summary(latencies["put"] + latencies["get"], errors["put"] + errors["get"], seconds),
+        "put": _summary(latencies["put"], errors["put"], seconds),
+        "get": _summary(latencies["get"], errors["get"], seconds),
+    }
+
+def run(client_counts, put_ratio, blob_size, rate, duration, durability, key_bits):
+    directory = tempfile.mkdtemp(prefix="password-loadtest-")
+    print("Generating %d keys..." % max(client_counts), file=sys.stderr)
+    keys = [signing.PrivateKey.generate(key_bits) for _ in range(max(client_counts))]
+    process, url = start_server(directory, durability)
+    report = {
+        "put_ratio": put_ratio,
+        "blob_size": blob_size,
+        "rate": rate,
+        "duration": duration,
+        "durability": durability,
+        "key_bits": key_bits,
+        "steps": [],
+    }
+    try:
+        for count in client_counts:
+            print("Running %d clients..." % count, file=sys.stderr)
+            clients = [_Client(url, key, blob_size) for key in keys[:count]]
+            report["steps"].append(run_step(clients, put_ratio, rate, duration))
+        _, _, body = storage_server.HttpTransport(url).request("GET", "/metrics")
+        report["server"] = json.loads(body.decode("utf-8"))
+    finally:
+        process.kill()
+        process.wait()
+    return report
+
+def print_table(report, out):
+    print("%8s %-5s %10s %8s %10s %10s %10s %10s" % ("clients", "op", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"), file=out)
+    for step in report["steps"]:
+        for op in ("total", "put", "get"):
+            result = step[op]
+            if not result["requests"]:
+                continue
+            print("%8d %-5s %10d %8d %10.1f %10.2f %10.2f %10.2f" % (
+                step["clients"], op, result["requests"], result["errors"], result["per_second"],
+                result["p50"] * 1000, result["p95"] * 1000, result["p99"] * 1000), file=out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test a local storage server")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64], dest="clients",
+                        help="number of concurrent clients, one run for each")
+    parser.add_argument("--put-ratio", type=float, default=0.2, dest="put_ratio", help="share of requests that are stores")
+    parser.add_argument("--blob-size", type=int, default=64 * 1024, dest="blob_size")
+    parser.add_argument("--rate", type=float, default=0, dest="rate", help="requests per second in total, 0 for as fast as possible")
+    parser.add_argument("--duration", type=float, default=10, dest="duration", help="seconds per run")
+    parser.add_argument("--durability", default="always", choices=storage_server.Persister.POLICIES, dest="durability")
+    parser.add_argument("--key-bits", type=int, default=signing.KEY_BITS, dest="key_bits")
+    parser.add_argument("-o", "--output", dest="output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args.clients, args.put_ratio, args.blob_size, args.rate, args.duration, args.durability, args.key_bits)
+    print_table(report, sys.stderr)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -7,9 +7,17 @@ import socket
 import time
 
 class Client():
+    """
+    Thread-safe client for the local server. Calls from several threads share
+    one connection and may be in flight at the same time.
+    """
+
     def __init__(self):
         self._lock = threading.Lock()
         self._socket = None
+        self._next_id = 0
+        # request id -> [event, (success, result)]
+        self._pending = {}
 
     def __getattr__(self, name):
         if name in dir(server._Server):
@@ -17,17 +25,48 @@ class Client():
                 return self._query(name, *args, **kwargs)
             return fun
 
+    def _connect(self):
+        server._start_if_missing()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(server.SOCKET_NAME)
+        thr = threading.Thread(target=self._read_responses, args=(self._socket,))
+        thr.daemon = True
+        thr.start()
+
+    def _read_responses(self, sock):
+        reader = server._FrameReader(sock)
+        try:
+            while True:
+                request_id, result = reader.read()
+                with self._lock:
+                    call = self._pending.pop(request_id, None)
+                if call is not None:
+                    call[1] = result
+                    call[0].set()
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            if self._socket is sock:
+                self._socket = None
+            pending = self._pending
+            self._pending = {}
+        sock.close()
+        for call in pending.values():
+            call[1] = False, "Connection to server lost: %s" % error
+            call[0].set()
+
     def _query(self, channel, *args, **kwargs):
+        call = [threading.Event(), None]
         with self._lock:
             if self._socket is None:
-                server._start_if_missing()
-                while not os.path.exists(server.SOCKET_NAME):
-                    time.sleep(0.1)
-                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self._socket.connect(server.SOCKET_NAME)
-            server._write_socket(self._socket, (channel, args, kwargs))
-            success, result = server._read_socket(self._socket)
-            if success:
-                return result
-            else:
-                raise OSError(result)
+                self._connect()
+            request_id = self._next_id
+            self._next_id = (self._next_id + 1) & 0xffffffff
+            self._pending[request_id] = call
+            self._socket.sendall(server._encode_frame(request_id, (channel, args, kwargs)))
+        call[0].wait()
+        success, result = call[1]
+        if success:
+            return result
+        else:
+            raise OSError(result)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import heapq
+
+_SEPARATORS = "/ .-_@:"
+
+def _trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+def _terms(query):
+    return [term for term in query.lower().split(" ") if term]
+
+class SearchIndex():
+    """
+    Trigram index over entry names. A name matches a query if every space
+    separated term of the query is a case-insensitive substring of the name.
+
+    The full match set of the last query is kept, so a query that only
+    extends the last one is answered by filtering that set.
+    """
+
+    def __init__(self, names=()):
+        self._names = {}
+        self._trigrams = {}
+        self._last_query = None
+        self._last_matches = None
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self._names:
+            return
+        lower = name.lower()
+        self._names[name] = lower
+        for trigram in _trigrams(lower):
+            self._trigrams.setdefault(trigram, set()).add(name)
+        self._last_query = None
+
+    def remove(self, name):
+        lower = self._names.pop(name, None)
+        if lower is None:
+            return
+        for trigram in _trigrams(lower):
+            names = self._trigrams[trigram]
+            names.discard(name)
+            if not names:
+                del self._trigrams[trigram]
+        self._last_query = None
+
+    def _candidates(self, terms):
+        candidates = None
+        for term in terms:
+            for trigram in _trigrams(term):
+                names = self._trigrams.get(trigram, ())
+                candidates = set(names) if candidates is None else candidates & names
+                if not candidates:
+                    return candidates
+        return self._names.keys() if candidates is None else candidates
+
+    def _match(self, query):
+        terms = _terms(query)
+        if self._last_query is not None and query.startswith(self._last_query):
+            # every term of the last query is a prefix of a term of this one
+            candidates = self._last_matches
+        else:
+            candidates = self._candidates(terms)
+        matches = set()
+        for name in candidates:
+            lower = self._names[name]
+            if all(term in lower for term in terms):
+                matches.add(name)
+        self._last_query = query
+        self._last_matches = matches
+        return terms, matches
+
+    def search(self, query, limit=None):
+        """
+        Returns the names matching query, best matches first: names where the
+        terms start a word, then shorter names.
+        """
+        terms, matches = self._match(query)
+
+        def rank(name):
+            lower = self._names[name]
+            penalty = 0
+            for term in terms:
+                pos = lower.find(term)
+                if pos > 0:
+                    penalty += 1 if lower[pos - 1] in _SEPARATORS else 2
+            return penalty, len(name), lower
+
+        if limit is None:
+            return sorted(matches, key=rank)
+        return heapq.nsmallest(limit, matches, key=rank)
@@ -8,10 +8,11 @@ import stat
 import multiprocessing
 import time
 import struct
-import session
 import traceback
 import subprocess
-import time
+import asyncio
+import select
+import concurrent.futures
 
 _here = os.path.dirname(__file__)
 SOCKET_NAME = os.path.join(_here, ".socket")
@@ -19,76 +20,195 @@ PID_FILE = os.path.join(_here, "local_server.pid")
 
 SESSION_TIMEOUT = 600 # 10 minutes
 
-def _read_socket(socket):
-    length, = struct.unpack("I", socket.recv(4))
-    return rencode.loads(socket.recv(length), decode_utf8=True)
+# Wire protocol: every message is a frame of
+# 00-04: payload length (uint32, big-endian)
+# 04-08: request id (uint32, big-endian)
+# 08-..: rencoded payload, (channel, args, kwargs) for requests and
+#        (success, result) for responses
+# Responses carry the id of their request and may arrive in any order.
+FRAME_HEADER = struct.Struct(">II")
+MAX_FRAME_SIZE = 16 << 20
+
+class FrameError(OSError):
+    pass
+
+class _FrameReader():
+    """
+    Reads frames from a blocking socket into one reusable buffer.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._buffer = bytearray(4096)
+
+    def _recv_into(self, view):
+        while len(view) > 0:
+            n = self._sock.recv_into(view)
+            if n == 0:
+                raise EOFError("Connection closed")
+            view = view[n:]
+
+    def read(self):
+        """
+        Returns the request id and the decoded payload.
+        """
+        view = memoryview(self._buffer)
+        self._recv_into(view[:FRAME_HEADER.size])
+        length, request_id = FRAME_HEADER.unpack_from(self._buffer)
+        if length > MAX_FRAME_SIZE:
+            raise FrameError("Frame of %d bytes exceeds maximum size" % length)
+        if length > len(self._buffer):
+            self._buffer = bytearray(max(length, 2 * len(self._buffer)))
+            view = memoryview(self._buffer)
+        self._recv_into(view[:length])
+        # rencode only decodes bytes, this is the one copy of the payload
+        return request_id, rencode.loads(bytes(view[:length]), decode_utf8=True)
 
-def _write_socket(socket, data):
+def _encode_frame(request_id, data):
     encoded = rencode.dumps(data)
-    socket.sendall(struct.pack("I", len(encoded)))
-    socket.sendall(encoded)
+    if len(encoded) > MAX_FRAME_SIZE:
+        raise FrameError("Frame of %d bytes exceeds maximum size" % len(encoded))
+    return FRAME_HEADER.pack(len(encoded), request_id) + encoded
+
+# RPCs that may run scrypt, crypto or network io. They run on a single
+# worker thread so they never stall the event loop, and are serialized among
+# each other since they change the session.
+_BLOCKING_CALLS = frozenset(("log_in", "add_password"))
+# RPCs that only wait for the session, they get their own threads
+_WAITING_CALLS = frozenset(("flush", "wait_saved"))
 
 class _Server():
-    def __init__(self):
-        self.session = session.Session()
+    """
+    The session module pulls in the crypto stack, which is slow to import.
+    It is only imported after the socket is ready, in the background, so the
+    first client does not have to wait for it.
+    """
+
+    def __init__(self, ready_fd=None, prewarm=False):
+        self.session = None
+        self._ready_fd = ready_fd
+        self._prewarm = prewarm
 
     def start(self):
+        asyncio.run(self._serve())
+
+    def _warm_up(self):
+        try:
+            import session
+            if self._prewarm:
+                import config
+                config.prefetch()
+        except:
+            traceback.print_exc()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._connections = set()
+        self._stopped = self._loop.create_future()
+        self._timeout_handle = None
         self._mark_used()
-        self._open_connections = 0
-        thr = threading.Thread(target=self._check_timeout)
-        thr.daemon = True
-        thr.start()
 
         oldmask = os.umask(0o77)
-        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self._sock.bind(SOCKET_NAME)
-        self._sock.listen(1)
-        os.umask(oldmask)
-
-        while True:
-            print("accept")
-            con, addr = self._sock.accept()
-            self._open_connections += 1
-            thr = threading.Thread(target=self._handle_connection, args=(con, addr))
-            thr.start()
+        try:
+            server = await asyncio.start_unix_server(self._handle_connection, SOCKET_NAME)
+        finally:
+            os.umask(oldmask)
+        if self._ready_fd is not None:
+            os.write(self._ready_fd, b"\001")
+            os.close(self._ready_fd)
+        thr = threading.Thread(target=self._warm_up)
+        thr.daemon = True
+        thr.start()
 
-    def _check_timeout(self):
-        while True:
-            if self._open_connections > 0:
-                self._mark_used()
-            wait_time = self._last_use - time.time() + SESSION_TIMEOUT
-            if wait_time <= 0:
-                self.stop_server()
-            else:
-                time.sleep(wait_time)
+        await self._stopped
+        # clean shutdown, just stop accepting connections and exit when done
+        server.close()
+        await server.wait_closed()
+        if self._connections:
+            await asyncio.wait(self._connections)
+        self._executor.shutdown()
+        if self.is_logged_in():
+            try:
+                await self._loop.run_in_executor(None, self.session.flush)
+            except Exception:
+                traceback.print_exc()
 
     def _mark_used(self):
-        self._last_use = time.time()
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+        self._timeout_handle = self._loop.call_later(SESSION_TIMEOUT, self._check_timeout)
 
-    def _handle_connection(self, connection, address):
+    def _check_timeout(self):
+        self._timeout_handle = None
+        # a prewarmed server waits for the first login, however long it takes
+        if self._connections or (self._prewarm and not self.is_logged_in()):
+            self._mark_used()
+        else:
+            self.stop_server()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        calls = set()
+        write_lock = asyncio.Lock()
         try:
             while True:
-                channel, args, kwargs = _read_socket(connection)
                 try:
-                    ret = getattr(self, channel)(*args, **kwargs)
-                    result = True, ret
-                except Exception as e:
-                    result = False, str(e)
-                    traceback.print_exc()
-                _write_socket(connection, result)
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                length, request_id = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    print("Frame of %d bytes exceeds maximum size, closing connection" % length)
+                    break
+                request = rencode.loads(await reader.readexactly(length), decode_utf8=True)
+                self._mark_used()
+                call = asyncio.ensure_future(self._call(writer, write_lock, request_id, request))
+                calls.add(call)
+                call.add_done_callback(calls.discard)
+            if calls:
+                await asyncio.wait(calls)
         finally:
-            connection.close()
-            self._open_connections -= 1
+            writer.close()
+            self._connections.discard(task)
             self._mark_used()
 
+    async def _call(self, writer, write_lock, request_id, request):
+        try:
+            channel, args, kwargs = request
+            fun = getattr(self, channel)
+            if channel in _BLOCKING_CALLS:
+                ret = await self._loop.run_in_executor(self._executor, lambda: fun(*args, **kwargs))
+            elif channel in _WAITING_CALLS:
+                ret = await self._loop.run_in_executor(None, lambda: fun(*args, **kwargs))
+            else:
+                ret = fun(*args, **kwargs)
+            result = True, ret
+        except Exception as e:
+            result = False, str(e)
+            traceback.print_exc()
+        try:
+            frame = _encode_frame(request_id, result)
+        except FrameError as e:
+            frame = _encode_frame(request_id, (False, str(e)))
+        async with write_lock:
+            writer.write(frame)
+            await writer.drain()
+
     def is_logged_in(self):
-        return self.session.logged_in
+        return self.session is not None and self.session.logged_in
 
     def log_in(self, password):
+        import session
+        self.session = session.Session(write_behind=True)
         return self.session.log_in(password)
 
-    def list_password_names(self):
-        return self.session.list_password_names()
+    def list_password_names(self, prefix=None):
+        return self.session.list_password_names(prefix)
+
+    def search(self, query, limit=None):
+        return self.session.search(query, limit)
 
     def add_password(self, name, password):
         self.session.add_password(name, password)
@@ -96,14 +216,30 @@ class _Server():
     def get_password(self, name):
         return self.session.get_password(name)
 
+    def flush(self):
+        self.session.flush()
+
+    def wait_saved(self, timeout=None):
+        return self.session.wait_saved(timeout)
+
+    def has_pending_changes(self):
+        return self.session.pending_changes
+
     def stop_server(self):
-        # clean shutdown, just stop accepting connections and exit when done
-        self._sock.shutdown(socket.SHUT_RDWR)
+        if not self._stopped.done():
+            self._stopped.set_result(None)
 
     def is_persistent(self):
         return self.session.persistent
 
-def _run():
+    def stats(self):
+        """
+        Aggregated timings of the storage pipeline, see storage.StatsCollector.
+        """
+        import storage
+        return storage.collector.stats() if storage.collector is not None else {}
+
+def _run(ready_fd=None, prewarm=False):
     our_pid = os.getpid()
     tmp_file = PID_FILE + "."
     with open(tmp_file, "w") as f:
@@ -113,23 +249,41 @@ def _run():
         try:
             os.kill(new_pid, 0)
             os.remove(tmp_file)
+            # closing ready_fd without writing tells the client to look for the other server
             return
         except OSError:
             pass
     os.rename(tmp_file, PID_FILE)
-    _Server().start()
+    _Server(ready_fd, prewarm).start()
 
-def _start_if_missing():
-    if _is_running():
-        return
+def _start_if_missing(timeout=10):
+    """
+    Starts the server unless it is running, and waits until its socket
+    accepts connections.
+    """
+    if not _is_running():
+        try:
+            os.remove(SOCKET_NAME)
+        except OSError:
+            pass
+        read_fd, write_fd = os.pipe()
+        try:
+            subprocess.Popen([os.path.abspath(__file__), "--ready-fd", str(write_fd)], pass_fds=(write_fd,))
+        finally:
+            os.close(write_fd)
+        try:
+            readable, _, _ = select.select([read_fd], [], [], timeout)
+            if readable and os.read(read_fd, 1):
+                return
+        finally:
+            os.close(read_fd)
 
-    try:
-        os.remove(SOCKET_NAME)
-    except OSError:
-        pass
-    #proc = multiprocessing.Process(target=_intern)
-    #proc.start()
-    subprocess.Popen(os.path.abspath(__file__))
+    # another server is running or starting up
+    deadline = time.time() + timeout
+    while not os.path.exists(SOCKET_NAME):
+        if time.time() > deadline:
+            raise OSError("Server did not start")
+        time.sleep(0.01)
 
 def _is_running():
     pid = _get_pid()
@@ -150,4 +304,14 @@ def _get_pid():
         return None
 
 if __name__ == '__main__':
-    _run()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ready-fd", type=int, dest="ready_fd")
+    # meant to be started like this with the desktop session, so the crypto
+    # stack is imported and the scrypt parameters are calibrated when the
+    # password prompt comes up. It stays up until the first login.
+    parser.add_argument("--prewarm", action="store_true", dest="prewarm")
+    args = parser.parse_args()
+
+    _run(args.ready_fd, args.prewarm)
@@ -1,42 +1,371 @@
 #!/usr/bin/env python3
 
 import config
+import storage
+import search
+import database
 import uuid
+import os
+import time
+import base64
+import collections
+import threading
+import traceback
+
+# how often a save is retried after merging concurrent changes from the server
+SAVE_ATTEMPTS = 3
+
+# decrypted passwords are kept for this many seconds, for at most this many entries
+PASSWORD_CACHE_TIME = 60
+PASSWORD_CACHE_SIZE = 16
+
+# with write-behind, a save starts once there were no changes for
+# WRITE_BEHIND_DELAY seconds, but at most WRITE_BEHIND_MAX_DELAY seconds after
+# the first unsaved change
+WRITE_BEHIND_DELAY = 1.0
+WRITE_BEHIND_MAX_DELAY = 10.0
+
+_WRAP_LABEL = b"entry-key"
+
+class _Version(collections.namedtuple("_Version", ("header", "db", "data_key", "wrap_key"))):
+    """
+    A published state of the session: the vault fields other than the
+    passwords, the passwords as a database.Database, the data key and the
+    subkey the data key is wrapped with in header. Never changed once
+    published; a change publishes a new version that shares everything
+    that did not change with the old one.
+    """
 
 class Session:
-    def __init__(self):
+    """
+    Vault layout:
+    {
+        "version": 1,
+        "key": sealed data key, wrapped with a subkey of the storage key,
+        "passwords": { name: { "secret": password sealed with the data key } }
+    }
+    Sealed values are base64 encoded, secrets are bound to their entry name.
+    Entries of version 0 vaults ({ "password": ... }) are sealed on load.
+
+    Readers work on the current _Version without locking. Writers publish
+    a new version under _lock, and save stores whatever version is current
+    while edits go on.
+
+    With write_behind, add_password only changes the session and a
+    background thread saves bursts of changes in one go.
+    """
+
+    def __init__(self, write_behind=False):
+        self.write_behind = write_behind
         self.pipeline = None
-        self.data = None
+        self._version = None
+        # names changed since the last load, these win when merging with a
+        # concurrently changed vault
+        self._changed = set()
+        # the search index is not immutable, searches and updates take _index_lock
+        self._index = None
+        self._index_lock = threading.Lock()
+        # name -> (secret, password, expiry)
+        self._passwords = collections.OrderedDict()
+        self._passwords_lock = threading.Lock()
+
+        # serializes writers and guards the bookkeeping below, never held during a save
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._saved = threading.Condition(self._lock)
+        # time of the first and last unsaved change, None if there is none
+        self._dirty_since = None
+        self._last_change = None
+        self._saving = False
+        self._saver = None
+        self.save_error = None
+        # loads are numbered when they start, a load that started before the
+        # one the current version is from must not replace it
+        self._loads = 0
+        self._published_load = 0
+
+    @property
+    def data(self):
+        """
+        The current vault in the stored layout.
+        """
+        version = self._version
+        return None if version is None else _to_json(version)
+
+    @property
+    def database(self):
+        """
+        The passwords of the current vault, do not change them.
+        """
+        return self._version.db
+
+    def _unwrap(self, data):
+        """
+        Returns the wrap key and the data key of a vault this thread just
+        loaded. May run scrypt, so never call it with the lock held.
+        """
+        if "key" not in data:
+            return None, os.urandom(32)
+        aes = self.pipeline.find(storage.ScryptAESStorageTransformer)
+        wrap_key = aes.subkey(_WRAP_LABEL)
+        return wrap_key, storage.unseal(wrap_key, base64.b64decode(data["key"]))
+
+    def _start_load(self):
+        """
+        Returns the number to pass to _set_data for a load that starts now.
+        """
+        with self._lock:
+            self._loads += 1
+            return self._loads
+
+    def _set_data(self, data, keys, number, overrides={}):
+        """
+        Called with the lock held. Publishes a freshly loaded vault with the
+        keys from _unwrap, with the passwords in overrides replacing its
+        entries, unless a load that started later was published already.
+        """
+        if number < self._published_load:
+            # e.g. the local copy returned on login, after a background
+            # refresh published the newer vault from the server
+            return
+        self._published_load = number
+        wrap_key, data_key = keys
+        data["version"] = 1
+        passwords = data.pop("passwords")
+        for name, entry in passwords.items():
+            if "password" in entry:
+                passwords[name] = { "secret": _seal(data_key, name, entry["password"]) }
+        db = database.Database.from_json(passwords)
+        for name, password in overrides.items():
+            db.put(database.Login(name, _seal(data_key, name, password)))
+        index = search.SearchIndex(db.names())
+        with self._index_lock:
+            self._index = index
+            self._version = _Version(data, db, data_key, wrap_key)
+        with self._passwords_lock:
+            self._passwords.clear()
 
     def init_empty(self):
-        self.data = { 
-            "version": 0,
-            "passwords": {} 
+        data = {
+            "version": 1,
+            "passwords": {}
         }
+        number = self._start_load()
+        with self._lock:
+            self._set_data(data, self._unwrap(data), number)
 
     @property
     def logged_in(self):
-        return self.data is not None
+        return self._version is not None
 
     @property
     def persistent(self):
         return self.pipeline.persistent
 
     def log_in(self, password, load=True):
-        self.pipeline = config.build_storage_pipeline(password)
+        self.pipeline = config.build_storage_pipeline(password, self._remote_changed)
         if load:
-            self.data = self.pipeline.load()
+            # with revalidate, the refresh this starts may publish a newer vault before this returns
+            number = self._start_load()
+            data = self.pipeline.load()
+            keys = self._unwrap(data)
+            with self._lock:
+                self._set_data(data, keys, number)
+                self._changed.clear()
+        self.pipeline.warm_up()
 
     def save(self):
-        self.pipeline.store(self.data)
+        with self._save_lock:
+            for attempt in range(SAVE_ATTEMPTS):
+                # may run scrypt when the calibrated parameters changed,
+                # readers of the lock must not wait for that
+                aes = self.pipeline.find(storage.ScryptAESStorageTransformer)
+                wrap_key = aes.store_subkey(_WRAP_LABEL)
+                with self._lock:
+                    version = self._wrap(wrap_key)
+                    changed = set(self._changed)
+                try:
+                    self.pipeline.store(_to_json(version))
+                except storage.ConflictError:
+                    if attempt == SAVE_ATTEMPTS - 1:
+                        raise
+                    number = self._start_load()
+                    remote = self.pipeline.load()
+                    keys = self._unwrap(remote)
+                    with self._lock:
+                        self._merge(remote, keys, number)
+                    continue
+                if self.pipeline.persistent:
+                    # otherwise the changes are still queued and may need merging later
+                    with self._lock:
+                        self._changed -= changed
+                return
 
-    def list_password_names(self):
-        return tuple(self.data["passwords"].keys())
+    def _schedule_save(self):
+        with self._lock:
+            now = time.time()
+            if self._dirty_since is None:
+                self._dirty_since = now
+            self._last_change = now
+            if self._saver is None:
+                self._saver = threading.Thread(target=self._save_behind)
+                self._saver.daemon = True
+                self._saver.start()
+            self._saved.notify_all()
+
+    def _save_behind(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._dirty_since is None:
+                        self._saver = None
+                        return
+                    now = time.time()
+                    due = min(self._last_change + WRITE_BEHIND_DELAY, self._dirty_since + WRITE_BEHIND_MAX_DELAY)
+                    if due <= now:
+                        break
+                    self._saved.wait(due - now)
+                self._dirty_since = None
+                self._last_change = None
+                self._saving = True
+                # waiters get the outcome of this attempt, not of the last
+                self.save_error = None
+            try:
+                self.save()
+            except Exception as e:
+                traceback.print_exc()
+                with self._lock:
+                    self.save_error = str(e)
+                    # try again after the next delay
+                    now = time.time()
+                    self._dirty_since = self._dirty_since or now
+                    self._last_change = self._last_change or now
+            finally:
+                with self._lock:
+                    self._saving = False
+                    self._saved.notify_all()
+
+    @property
+    def pending_changes(self):
+        # without the lock, the daemon asks on its event loop
+        return self._dirty_since is not None or self._saving
+
+    def flush(self):
+        """
+        Starts a pending write-behind save right away and waits for it.
+        """
+        with self._lock:
+            if self._dirty_since is not None:
+                self._dirty_since = self._last_change = 0
+                # the error of an earlier attempt is not the outcome of this one
+                self.save_error = None
+                self._saved.notify_all()
+        return self.wait_saved()
+
+    def wait_saved(self, timeout=None):
+        """
+        Waits until no changes are pending. Returns False on timeout, raises
+        if the last save failed.
+        """
+        with self._lock:
+            if not self._saved.wait_for(lambda: not self.pending_changes or self.save_error is not None, timeout):
+                return False
+        if self.save_error is not None:
+            raise IOError("Saving failed: %s" % self.save_error)
+        return True
+
+    def _wrap(self, wrap_key):
+        # called with the lock held, returns the version to store
+        version = self._version
+        if wrap_key != version.wrap_key:
+            header = dict(version.header)
+            header["key"] = base64.b64encode(storage.seal(wrap_key, version.data_key)).decode("ascii")
+            version = self._version = version._replace(header=header, wrap_key=wrap_key)
+        return version
+
+    def _remote_changed(self):
+        # newer data arrived from the server in the background
+        number = self._start_load()
+        remote = self.pipeline.load()
+        keys = self._unwrap(remote)
+        with self._lock:
+            self._merge(remote, keys, number)
+            changed = bool(self._changed)
+        if changed:
+            self.save()
+
+    def _merge(self, remote, keys, number):
+        # called with the lock held, the remote vault may use another data key
+        changed = { name: self.get_password(name) for name in self._changed }
+        self._set_data(remote, keys, number, changed)
+
+    def list_password_names(self, prefix=None):
+        """
+        Returns the names, sorted, only those starting with prefix if given.
+        """
+        if prefix is None:
+            return self._version.db.names()
+        return self._version.db.prefix(prefix)
+
+    def search(self, query, limit=None):
+        with self._index_lock:
+            return self._index.search(query, limit)
 
     def add_password(self, name, password, save=True):
-        self.data["passwords"][name] = { "password": password }
+        self.add_passwords(((name, password),), save)
+
+    def add_passwords(self, entries, save=True):
+        """
+        Adds (name, password) pairs, publishing one new version for all of
+        them.
+        """
+        with self._lock:
+            version = self._version
+            db = version.db.copy()
+            names = []
+            for name, password in entries:
+                db.put(database.Login(name, _seal(version.data_key, name, password)))
+                names.append(name)
+            with self._index_lock:
+                self._version = version._replace(db=db)
+                for name in names:
+                    self._index.add(name)
+            self._changed.update(names)
         if save:
-            self.save()
+            if self.write_behind:
+                self._schedule_save()
+            else:
+                self.save()
 
     def get_password(self, name):
-        return self.data["passwords"][name]["password"]
+        version = self._version
+        login = version.db.get(name)
+        if login is None:
+            raise KeyError(name)
+        secret = login.secret
+        now = time.time()
+        with self._passwords_lock:
+            for expired in [k for k, (_, _, expiry) in self._passwords.items() if expiry <= now]:
+                del self._passwords[expired]
+            cached = self._passwords.get(name)
+            # an entry changed since it was cached has another secret
+            if cached is not None and cached[0] == secret:
+                self._passwords.move_to_end(name)
+                return cached[1]
+
+        password = storage.unseal(version.data_key, base64.b64decode(secret), name.encode("utf-8")).decode("utf-8")
+        with self._passwords_lock:
+            self._passwords[name] = secret, password, now + PASSWORD_CACHE_TIME
+            self._passwords.move_to_end(name)
+            while len(self._passwords) > PASSWORD_CACHE_SIZE:
+                self._passwords.popitem(last=False)
+        return password
+
+def _seal(data_key, name, password):
+    sealed = storage.seal(data_key, password.encode("utf-8"), name.encode("utf-8"))
+    return base64.b64encode(sealed).decode("ascii")
+
+def _to_json(version):
+    data = dict(version.header)
+    data["passwords"] = version.db.to_json()
+    return data
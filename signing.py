@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import functools
+import hashlib
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from Crypto.Hash import SHA512
+from Crypto.Util.asn1 import DerSequence
+from Crypto.IO import PEM
+
+# RSASSA-PKCS1-v1_5 with SHA-512, the scheme the rsa package used, so keys
+# and signatures made with it stay valid
+KEY_BITS = 2048
+
+class PublicKey(object):
+    def __init__(self, key):
+        self._key = key
+        self._der = DerSequence([key.n, key.e]).encode()
+
+    @staticmethod
+    def load(data):
+        """
+        Loads a PKCS#1 public key, DER or PEM.
+        """
+        return _load_public_key(bytes(data))
+
+    def save(self, format="DER"):
+        """
+        Returns the key as PKCS#1, DER or PEM.
+        """
+        if format == "PEM":
+            return PEM.encode(self._der, "RSA PUBLIC KEY").encode("ascii") + b"\n"
+        return self._der
+
+    @property
+    def fingerprint(self):
+        """
+        Hex SHA-256 of the DER encoding, names the vault of this key on a
+        storage server.
+        """
+        return hashlib.sha256(self._der).hexdigest()
+
+    def verify(self, data, signature):
+        """
+        Returns whether signature is valid for data.
+        """
+        try:
+            pkcs1_15.new(self._key).verify(SHA512.new(data), signature)
+            return True
+        except ValueError:
+            return False
+
+    def __eq__(self, other):
+        return isinstance(other, PublicKey) and self._der == other._der
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._der)
+
+class PrivateKey(object):
+    def __init__(self, key):
+        self._key = key
+        self._signer = pkcs1_15.new(key)
+        self._der = key.export_key(format="DER", pkcs=1)
+        self.public_key = PublicKey(key.public_key())
+
+    @staticmethod
+    def generate(bits=KEY_BITS):
+        return PrivateKey(RSA.generate(bits))
+
+    @staticmethod
+    def load(data):
+        """
+        Loads a PKCS#1 DER private key.
+        """
+        return _load_private_key(bytes(data))
+
+    def save(self):
+        """
+        Returns the key as PKCS#1 DER.
+        """
+        return self._der
+
+    @property
+    def signature_size(self):
+        return self._key.size_in_bytes()
+
+    def sign(self, data):
+        return self._signer.sign(SHA512.new(data))
+
+    def sign_hash(self, digest):
+        """
+        Signs a hash object from new_hash that the data was fed into.
+        """
+        return self._signer.sign(digest)
+
+def new_hash():
+    return SHA512.new()
+
+# keys are parsed again on every load of the vault and every PUT
+@functools.lru_cache(maxsize=16)
+def _load_public_key(data):
+    return PublicKey(RSA.import_key(data))
+
+@functools.lru_cache(maxsize=4)
+def _load_private_key(data):
+    return PrivateKey(RSA.import_key(data))
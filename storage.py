@@ -5,19 +5,332 @@ import json
 from Crypto.Cipher import AES
 import scrypt
 import gzip
+import zlib
+import lzma
+import bz2
+import itertools
+import codecs
 import traceback
 import struct
+import threading
+import time
+import hmac
+import hashlib
+import functools
+import contextlib
+import collections
+import socket
+import concurrent.futures
+
+class ConflictError(Exception):
+    """
+    Raised by store when the stored data was changed by someone else since it
+    was last loaded. Load again, merge and retry.
+    """
+
+# size of the chunks passed between streaming stages
+CHUNK_SIZE = 64 * 1024
+
+class _ChunkReader(object):
+    """
+    File-like reading from an iterable of bytes chunks.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, n):
+        while len(self._buffer) < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return data
+
+    def rest(self):
+        if self._buffer:
+            yield self._buffer
+            self._buffer = b""
+        yield from self._chunks
+
+def _rechunk(chunks, joiner):
+    # the json encoder yields tiny pieces, pass them on in CHUNK_SIZE batches
+    batch = []
+    size = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            yield joiner.join(batch)
+            batch = []
+            size = 0
+    if batch:
+        yield joiner.join(batch)
+
+class StatsCollector(object):
+    """
+    Aggregates the events measured in the pipeline by name: how often they
+    happened, how many failed, total and maximum seconds and bytes in and out.
+
+    Every load, store, load_stream and store_stream of a provider is an event
+    named after the class and the method, e.g. "ScryptAESStorageTransformer.store".
+    Its time includes the stages after it, and for streams the time spent
+    producing the chunks. Calls of a provider from within itself are not
+    counted separately. The steps that are usually slow are
+    events of their own: "kdf", "cipher", "compress", "decompress",
+    "keygen", "sign", "verify" and "network".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def record(self, name, seconds, bytes_in=0, bytes_out=0, error=False):
+        with self._lock:
+            event = self._events.get(name)
+            if event is None:
+                event = self._events[name] = {
+                    "count": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                }
+            event["count"] += 1
+            event["errors"] += 1 if error else 0
+            event["seconds"] += seconds
+            event["max_seconds"] = max(event["max_seconds"], seconds)
+            event["bytes_in"] += bytes_in
+            event["bytes_out"] += bytes_out
+
+    def stats(self):
+        with self._lock:
+            return { name: dict(event) for name, event in self._events.items() }
+
+    def reset(self):
+        with self._lock:
+            self._events = {}
+
+# receives all events, anything with a record method like StatsCollector.record
+collector = StatsCollector()
+
+def set_collector(new_collector):
+    """
+    Replaces the collector, None turns measuring off.
+    """
+    global collector
+    collector = new_collector
+
+class Measurement(object):
+    """
+    Times the blocks it is used as context manager for, possibly several,
+    until record is called.
+    """
+
+    def __init__(self, name, bytes_in=0):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.error = False
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.seconds += time.perf_counter() - self._start
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self.error = True
+
+    def record(self):
+        if collector is not None:
+            collector.record(self.name, self.seconds, self.bytes_in, self.bytes_out, self.error)
+
+@contextlib.contextmanager
+def measure(name, bytes_in=0):
+    measurement = Measurement(name, bytes_in)
+    try:
+        with measurement:
+            yield measurement
+    finally:
+        measurement.record()
+
+_measuring = threading.local()
+
+def _active_stages():
+    active = getattr(_measuring, "stages", None)
+    if active is None:
+        active = _measuring.stages = set()
+    return active
+
+def _size(obj):
+    return len(obj) if isinstance(obj, (bytes, str)) else 0
+
+def _measured_load(fun):
+    @functools.wraps(fun)
+    def load(self):
+        active = _active_stages()
+        if collector is None or id(self) in active:
+            return fun(self)
+        active.add(id(self))
+        try:
+            with measure(type(self).__name__ + ".load") as measurement:
+                obj = fun(self)
+                measurement.bytes_out = _size(obj)
+                return obj
+        finally:
+            active.discard(id(self))
+    return load
+
+def _measured_store(fun):
+    @functools.wraps(fun)
+    def store(self, obj):
+        active = _active_stages()
+        if collector is None or id(self) in active:
+            return fun(self, obj)
+        active.add(id(self))
+        try:
+            with measure(type(self).__name__ + ".store", _size(obj)):
+                return fun(self, obj)
+        finally:
+            active.discard(id(self))
+    return store
+
+def _counted(chunks, measurement):
+    for chunk in chunks:
+        measurement.bytes_in += len(chunk)
+        yield chunk
+
+def _measured_store_stream(fun):
+    @functools.wraps(fun)
+    def store_stream(self, chunks):
+        active = _active_stages()
+        if collector is None or id(self) in active:
+            return fun(self, chunks)
+        active.add(id(self))
+        try:
+            with measure(type(self).__name__ + ".store_stream") as measurement:
+                return fun(self, _counted(chunks, measurement))
+        finally:
+            active.discard(id(self))
+    return store_stream
+
+def _measured_load_stream(fun):
+    @functools.wraps(fun)
+    def load_stream(self):
+        if collector is None or id(self) in _active_stages():
+            return fun(self)
+        return _timed_chunks(self, fun)
+    return load_stream
+
+def _timed_chunks(self, fun):
+    # only the time spent producing the chunks counts, not the consumer's
+    measurement = Measurement(type(self).__name__ + ".load_stream")
+    try:
+        chunks = None
+        while True:
+            active = _active_stages()
+            active.add(id(self))
+            try:
+                with measurement:
+                    if chunks is None:
+                        chunks = iter(fun(self))
+                    chunk = next(chunks, None)
+            finally:
+                active.discard(id(self))
+            if chunk is None:
+                return
+            measurement.bytes_out += len(chunk)
+            yield chunk
+    finally:
+        measurement.record()
+
+_MEASURED_METHODS = {
+    "load": _measured_load,
+    "store": _measured_store,
+    "load_stream": _measured_load_stream,
+    "store_stream": _measured_store_stream,
+}
+
+class DecryptionError(Exception):
+    pass
+
+def seal(key, data, aad=b""):
+    """
+    Encrypts data with AES-GCM, authenticating aad along with it.
+
+    Sealed format:
+    00-01: version (1)
+    01-13: nonce
+    13-..: ciphertext
+    last 16 bytes: tag
+    """
+    nonce = os.urandom(12)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    enc, tag = cipher.encrypt_and_digest(data)
+    return b"\001" + nonce + enc + tag
+
+def unseal(key, data, aad=b""):
+    if data[0:1] != b"\001":
+        raise DecryptionError("Unknown sealed data version")
+    cipher = AES.new(key, AES.MODE_GCM, nonce=data[1:13])
+    cipher.update(aad)
+    try:
+        return cipher.decrypt_and_verify(data[13:-16], data[-16:])
+    except ValueError:
+        raise DecryptionError("Sealed data is corrupt or the key is wrong")
 
 class StorageProvider(object):
     def __init__(self, input_type):
         self.input_type = input_type
 
+    def __init_subclass__(cls, **kwargs):
+        # every provider reports its loads and stores to the collector
+        super(StorageProvider, cls).__init_subclass__(**kwargs)
+        for name, wrap in _MEASURED_METHODS.items():
+            if name in cls.__dict__:
+                setattr(cls, name, wrap(cls.__dict__[name]))
+
     def load(self):
         return None
 
     def store(self, obj):
         pass
 
+    def load_stream(self):
+        """
+        Like load, but returns an iterable of chunks. Only meaningful for str
+        and bytes providers, the default implementation loads everything.
+        """
+        return iter((self.load(),))
+
+    def store_stream(self, chunks):
+        """
+        Like store, but takes an iterable of chunks. Only meaningful for str
+        and bytes providers, the default implementation joins them.
+        """
+        self.store(self.input_type().join(chunks))
+
+    def find(self, cl):
+        """
+        Returns the first provider of the given class in this pipeline.
+        """
+        return self if isinstance(self, cl) else None
+
+    def warm_up(self):
+        """
+        Called after logging in, to prepare slow work the first store would
+        otherwise have to wait for.
+        """
+        pass
+
     @property
     def persistent(self):
         return True
@@ -37,6 +350,12 @@ class StorageTransformer(StorageProvider):
     def store(self, obj):
         return self._nxt.store(obj)
 
+    def find(self, cl):
+        return self if isinstance(self, cl) else self._nxt.find(cl)
+
+    def warm_up(self):
+        self._nxt.warm_up()
+
     @property
     def persistent(self):
         return self._nxt.persistent
@@ -51,21 +370,54 @@ class StringEncoder(StorageTransformer):
     def store(self, obj):
         super(StringEncoder, self).store(obj.encode("utf-8"))
 
+    def load_stream(self):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in self._nxt.load_stream():
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def store_stream(self, chunks):
+        self._nxt.store_stream(chunk.encode("utf-8") for chunk in chunks)
+
 class JsonStorageTransformer(StorageTransformer):
     def __init__(self, nxt):
         super(JsonStorageTransformer, self).__init__(dict, str, nxt)
 
     def load(self):
-        return json.loads(super(JsonStorageTransformer, self).load())
+        return json.loads("".join(self._nxt.load_stream()))
 
     def store(self, obj):
-        super(JsonStorageTransformer, self).store(json.dumps(obj))
+        self._nxt.store_stream(_rechunk(json.JSONEncoder().iterencode(obj), ""))
+
+# derived keys kept by ScryptAESStorageTransformer
+KEY_CACHE_SIZE = 4
 
 class ScryptAESStorageTransformer(StorageTransformer):
     """
     All integers are big-endian.
 
     Blob format:
+    00-04: magic "PWDB"
+    04-05: format version (3)
+    05-21: salt
+    21-25: exponent of N scrypt parameter
+    25-29: r scrypt parameter
+    29-33: p scrypt parameter
+    33-49: key check, first 16 bytes of HMAC-SHA256(key, "key-check")
+    49-61: nonce
+    61-..: data encrypted with AES-GCM, authenticating bytes 00-61
+    last 16 bytes: tag
+
+    The key check makes a wrong password fail before decrypting anything.
+
+    The key is derived in p lanes that run in parallel, see _scrypt_lanes.
+
+    Blobs not starting with the magic are in the old format (version 1),
+    which is still read but replaced on the next store:
     00-16: salt
     16-20: exponent of N scrypt parameter
     20-24: r scrypt parameter
@@ -73,12 +425,17 @@ class ScryptAESStorageTransformer(StorageTransformer):
     28-44: iv
     44-..: encrypted data block
 
-    encrypted block format:
+    encrypted block format (AES-CBC):
     00-04: data length (uint32)
     04-..: data
     encrypted block is padded with arbitrary bytes to multiples of 16
     """
 
+    MAGIC = b"PWDB"
+    VERSION = 3
+    HEADER = struct.Struct(">4sB16sIII16s12s")
+    TAG_SIZE = 16
+
     def __init__(self, nxt, password):
         super(ScryptAESStorageTransformer, self).__init__(bytes, bytes, nxt)
         self.password = password.encode("utf-8")
@@ -88,34 +445,311 @@ class ScryptAESStorageTransformer(StorageTransformer):
         self.r = 8
         self.p = 1
 
-    def load(self):
-        data = super(ScryptAESStorageTransformer, self).load()
+        # (salt, Np, r, p, version) -> key, for the few blobs in use
+        self._keys_lock = threading.Lock()
+        self._keys = collections.OrderedDict()
+        # salt of the first blob loaded or stored with the current
+        # parameters. It is kept across saves so a store only needs a fresh
+        # nonce, not a new scrypt run, and loads never change it, so the
+        # subkey from store_subkey matches every following store.
+        self._salt = None
+        # (salt, Np, r, p, version) of the blob each thread loaded last
+        self._loaded = threading.local()
+
+    def invalidate_key(self):
+        with self._keys_lock:
+            self._keys.clear()
+            self._salt = None
+
+    def set_password(self, password):
+        self.password = password.encode("utf-8")
+        self.invalidate_key()
+
+    def set_parameters(self, Np, r, p):
+        self.Np = Np
+        self.r = r
+        self.p = p
+        self.invalidate_key()
+
+    def _derive_key(self, salt, Np, r, p, version):
+        params = salt, Np, r, p, version
+        with self._keys_lock:
+            key = self._keys.get(params)
+        if key is not None:
+            return key
+        with measure("kdf"):
+            if version == self.VERSION:
+                key = _scrypt_lanes(self.password, salt, Np, r, p, self.keylen)
+            else:
+                key = scrypt.hash(self.password, salt, 1 << Np, r, p, buflen=self.keylen)
+        with self._keys_lock:
+            self._keys[params] = key
+            while len(self._keys) > KEY_CACHE_SIZE:
+                self._keys.popitem(last=False)
+        return key
+
+    def subkey(self, label):
+        """
+        Key for other uses than the blob, derived from the key of the blob
+        the calling thread loaded last through load or load_stream. Blobs
+        decrypted with decrypt, like journal records, don't count.
+        """
+        params = getattr(self._loaded, "params", None)
+        if params is None:
+            raise ValueError("No vault was loaded")
+        return hmac.new(self._derive_key(*params), label, hashlib.sha256).digest()
+
+    def store_subkey(self, label):
+        """
+        Like subkey, but derived from the key the next store will use.
+        """
+        key = self._derive_key(self._store_salt(), self.Np, self.r, self.p, self.VERSION)
+        return hmac.new(key, label, hashlib.sha256).digest()
+
+    def _store_salt(self):
+        with self._keys_lock:
+            if self._salt is None:
+                self._salt = os.urandom(16)
+            return self._salt
+
+    def _loaded_blob(self, salt, Np, r, p, version):
+        self._loaded.params = salt, Np, r, p, version
+        if (Np, r, p, version) == (self.Np, self.r, self.p, self.VERSION):
+            with self._keys_lock:
+                if self._salt is None:
+                    self._salt = salt
+
+    def encrypt(self, obj):
+        return b"".join(self._encrypt_chunks((obj,)))
+
+    def _encrypt_chunks(self, chunks):
+        salt = self._store_salt()
+        key = self._derive_key(salt, self.Np, self.r, self.p, self.VERSION)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, salt, self.Np, self.r, self.p, _key_check(key), os.urandom(12))
+        cipher = self._cipher(key, header)
+        yield header
+
+        measurement = Measurement("cipher")
+        try:
+            for chunk in chunks:
+                with measurement:
+                    enc = cipher.encrypt(chunk)
+                measurement.bytes_in += len(chunk)
+                measurement.bytes_out += len(enc)
+                yield enc
+            with measurement:
+                tag = cipher.digest()
+            yield tag
+        finally:
+            measurement.record()
+
+    def _cipher(self, key, header):
+        cipher = AES.new(key, AES.MODE_GCM, nonce=header[-12:])
+        cipher.update(header)
+        return cipher
+
+    def _open(self, header, loaded=False):
+        """
+        Returns the cipher for the blob with the given header.
+        """
+        if len(header) < self.HEADER.size:
+            raise DecryptionError("Vault is truncated")
+        _, version, salt, Np, r, p, check, _ = self.HEADER.unpack(header)
+        if version != self.VERSION:
+            raise DecryptionError("Unknown vault format version %d" % version)
+        key = self._derive_key(salt, Np, r, p, version)
+        if not hmac.compare_digest(check, _key_check(key)):
+            raise DecryptionError("Wrong password")
+        if loaded:
+            self._loaded_blob(salt, Np, r, p, version)
+        return self._cipher(key, header)
+
+    def decrypt(self, data, loaded=False):
+        if data[:4] != self.MAGIC:
+            return self._decrypt_legacy(data, loaded)
+        if len(data) < self.HEADER.size + self.TAG_SIZE:
+            raise DecryptionError("Vault is truncated")
+        cipher = self._open(data[:self.HEADER.size], loaded)
+        enc = data[self.HEADER.size:-self.TAG_SIZE]
+        with measure("cipher", len(enc)) as measurement:
+            try:
+                dec = cipher.decrypt_and_verify(enc, data[-self.TAG_SIZE:])
+            except ValueError:
+                raise DecryptionError("Vault is corrupt")
+            measurement.bytes_out = len(dec)
+        return dec
+
+    def _decrypt_legacy(self, data, loaded=False):
         salt = data[0:16]
         Np = struct.unpack(">I", data[16:20])[0]
         r = struct.unpack(">I", data[20:24])[0]
         p = struct.unpack(">I", data[24:28])[0]
         iv = data[28:44]
         enc = data[44:]
-        key = scrypt.hash(self.password, salt, 1 << Np, r, p, buflen=self.keylen)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        dec = cipher.decrypt(enc)
+        key = self._derive_key(salt, Np, r, p, 1)
+        with measure("cipher", len(enc)) as measurement:
+            cipher = AES.new(key, AES.MODE_CBC, iv)
+            dec = cipher.decrypt(enc)
+            measurement.bytes_out = len(dec)
         block_len = struct.unpack(">I", dec[:4])[0]
+        if block_len > len(dec) - 4:
+            # no authentication in this format, but this catches most wrong passwords
+            raise DecryptionError("Wrong password or corrupt vault")
+        if loaded:
+            self._loaded_blob(salt, Np, r, p, 1)
         return dec[4:4 + block_len]
 
+    def load(self):
+        return self.decrypt(super(ScryptAESStorageTransformer, self).load(), True)
+
     def store(self, obj):
-        salt = os.urandom(16)
-        iv = os.urandom(16)
-        Np = struct.pack(">I", self.Np)
-        r = struct.pack(">I", self.r)
-        p = struct.pack(">I", self.p)
-        key = scrypt.hash(self.password, salt, 1 << self.Np, self.r, self.p, buflen=self.keylen)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        obj = struct.pack(">I", len(obj)) + obj
-        if (len(obj) % 16) != 0:
-            obj += (16 - (len(obj) % 16)) * b"\000"
-        enc = cipher.encrypt(obj)
-        data = salt + Np + r + p + iv + enc
-        return super(ScryptAESStorageTransformer, self).store(data)
+        return super(ScryptAESStorageTransformer, self).store(self.encrypt(obj))
+
+    def load_stream(self):
+        """
+        The tag is only checked at the end, the chunks can only be trusted
+        once the stream ended without DecryptionError.
+        """
+        reader = _ChunkReader(self._nxt.load_stream())
+        magic = reader.read(4)
+        if magic != self.MAGIC:
+            yield from self._load_stream_legacy(magic + reader.read(40), reader)
+            return
+        cipher = self._open(magic + reader.read(self.HEADER.size - 4), True)
+
+        # the last TAG_SIZE bytes seen so far may be the tag
+        pending = b""
+        measurement = Measurement("cipher")
+        try:
+            for chunk in reader.rest():
+                pending += chunk
+                if len(pending) <= self.TAG_SIZE:
+                    continue
+                with measurement:
+                    dec = cipher.decrypt(pending[:-self.TAG_SIZE])
+                measurement.bytes_in += len(dec)
+                measurement.bytes_out += len(dec)
+                pending = pending[-self.TAG_SIZE:]
+                yield dec
+            if len(pending) != self.TAG_SIZE:
+                raise DecryptionError("Vault is truncated")
+            try:
+                with measurement:
+                    cipher.verify(pending)
+            except ValueError:
+                raise DecryptionError("Vault is corrupt")
+        finally:
+            measurement.record()
+
+    def _load_stream_legacy(self, header, reader):
+        salt = header[0:16]
+        Np, r, p = struct.unpack(">III", header[16:28])
+        cipher = AES.new(self._derive_key(salt, Np, r, p, 1), AES.MODE_CBC, header[28:44])
+        self._loaded_blob(salt, Np, r, p, 1)
+        remaining = None
+        pending = b""
+        measurement = Measurement("cipher")
+        try:
+            for chunk in reader.rest():
+                pending += chunk
+                usable = len(pending) - len(pending) % 16
+                if usable == 0:
+                    continue
+                with measurement:
+                    dec = cipher.decrypt(pending[:usable])
+                measurement.bytes_in += usable
+                measurement.bytes_out += usable
+                pending = pending[usable:]
+                if remaining is None:
+                    remaining = struct.unpack(">I", dec[:4])[0]
+                    dec = dec[4:]
+                dec = dec[:remaining]
+                remaining -= len(dec)
+                if dec:
+                    yield dec
+            if remaining != 0:
+                raise DecryptionError("Wrong password or corrupt vault")
+        finally:
+            measurement.record()
+
+    def store_stream(self, chunks):
+        self._nxt.store_stream(self._encrypt_chunks(chunks))
+
+def _key_check(key):
+    return hmac.new(key, b"key-check", hashlib.sha256).digest()[:16]
+
+def _scrypt_lanes(password, salt, Np, r, p, keylen):
+    """
+    SHA-256 of the concatenated keys of p independent scrypt runs with
+    parameter p = 1, lane i salted with salt + uint32 i. The runs release the
+    GIL, so they use p cores at once.
+    """
+    def lane(i):
+        return scrypt.hash(password, salt + struct.pack(">I", i), 1 << Np, r, 1, buflen=keylen)
+    if p == 1:
+        keys = [lane(0)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=p) as executor:
+            keys = list(executor.map(lane, range(p)))
+    return hashlib.sha256(b"".join(keys)).digest()[:keylen]
+
+def calibrate_scrypt(target_seconds, max_memory, r=8, p=None, min_Np=14):
+    """
+    Returns the (Np, r, p) that make ScryptAESStorageTransformer derive a key
+    in about target_seconds on this host using at most max_memory bytes,
+    with one lane per core unless p is given. Np never goes below min_Np,
+    raises ValueError if max_memory does not allow that.
+    """
+    if p is None:
+        p = os.cpu_count() or 1
+    # a lane takes 128 * r * N bytes
+    while p > 1 and 128 * r * (1 << min_Np) * p > max_memory:
+        p -= 1
+    if 128 * r * (1 << min_Np) * p > max_memory:
+        raise ValueError("scrypt with Np = %d, r = %d, p = %d needs more than %d bytes" % (min_Np, r, p, max_memory))
+    Np = 10
+    while True:
+        start = time.perf_counter()
+        _scrypt_lanes(b"calibration", os.urandom(16), Np, r, p, 32)
+        elapsed = time.perf_counter() - start
+        # each step doubles time and memory
+        if elapsed * 2 > target_seconds or 128 * r * (2 << Np) * p > max_memory:
+            break
+        Np += 1
+    return max(Np, min_Np), r, p
+
+def load_scrypt_parameters(filename, target_seconds, max_memory):
+    """
+    Returns the calibrated scrypt parameters for this host, calibrating
+    first if filename has none for these settings.
+
+    File format (json):
+    { host name: { "target_seconds", "max_memory", "Np", "r", "p" } }
+    """
+    filename = os.path.join(os.path.dirname(__file__), filename)
+    host = socket.gethostname()
+    try:
+        with open(filename, "r") as f:
+            hosts = json.load(f)
+    except (IOError, ValueError):
+        hosts = {}
+    cached = hosts.get(host)
+    if cached is not None and (cached["target_seconds"], cached["max_memory"]) == (target_seconds, max_memory):
+        return cached["Np"], cached["r"], cached["p"]
+
+    Np, r, p = calibrate_scrypt(target_seconds, max_memory)
+    hosts[host] = {
+        "target_seconds": target_seconds,
+        "max_memory": max_memory,
+        "Np": Np,
+        "r": r,
+        "p": p,
+    }
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(hosts, f, indent=2)
+    os.replace(tmp, filename)
+    return Np, r, p
 
 class FileStorageProvider(StorageProvider):
     def __init__(self, filename):
@@ -130,6 +764,28 @@ class FileStorageProvider(StorageProvider):
         with open(self.filename, "w") as f:
             f.buffer.write(obj)
 
+    def load_stream(self):
+        with open(self.filename, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def store_stream(self, chunks):
+        with open(self.filename, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def delete(self):
+        os.remove(self.filename)
+
+    def rename(self, filename):
+        os.replace(self.filename, filename)
+
 class GzipTransformer(StorageTransformer):
     def __init__(self, nxt):
         super(GzipTransformer, self).__init__(bytes, bytes, nxt)
@@ -140,33 +796,552 @@ class GzipTransformer(StorageTransformer):
     def store(self, obj):
         super(GzipTransformer, self).store(gzip.compress(obj))
 
+    def load_stream(self):
+        decompressor = zlib.decompressobj(31)
+        for chunk in self._nxt.load_stream():
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def store_stream(self, chunks):
+        self._nxt.store_stream(self._compress(chunks))
+
+    def _compress(self, chunks):
+        # same settings as gzip.compress
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+class _Identity(object):
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return b""
+
+# strings that occur in every vault, preset for the zdict codec
+_VAULT_DICTIONARY = (
+    b'.com/login/mail/work/github/google/amazon/bank/'
+    b'{"version": 1, "passwords": {"'
+    b'"}, "key": "AQ'
+    b'": {"secret": "AQ'
+    b'"}, "'
+)
+
+class _Codec(object):
+    def __init__(self, codec_id, name, levels, compressor, decompressor):
+        self.codec_id = codec_id
+        self.name = name
+        self.levels = levels
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+_CODECS = (
+    _Codec(0, "none", (0,), lambda level: _Identity(), lambda: _Identity()),
+    _Codec(1, "zlib", (1, 6, 9), lambda level: zlib.compressobj(level), lambda: zlib.decompressobj()),
+    _Codec(2, "lzma", (0, 6), lambda level: lzma.LZMACompressor(preset=level), lambda: lzma.LZMADecompressor()),
+    _Codec(3, "bz2", (1, 9), lambda level: bz2.BZ2Compressor(level), lambda: bz2.BZ2Decompressor()),
+    _Codec(4, "zdict", (1, 6, 9), lambda level: zlib.compressobj(level, zdict=_VAULT_DICTIONARY),
+           lambda: zlib.decompressobj(zdict=_VAULT_DICTIONARY)),
+)
+_CODECS_BY_ID = { codec.codec_id: codec for codec in _CODECS }
+_CODECS_BY_NAME = { codec.name: codec for codec in _CODECS }
+
+class CompressionTransformer(StorageTransformer):
+    """
+    Compresses with a configurable codec, or with the codec and level that
+    benchmark best on the data being stored according to policy:
+
+    fastest:  least time to compress
+    smallest: smallest output
+    balanced: least time to compress and transfer the output at bandwidth
+              bytes per second
+
+    The benchmark runs on the first SAMPLE_SIZE bytes, every
+    benchmark_interval stores.
+
+    Blob format:
+    00-01: codec id
+    01-02: level
+    02-..: compressed data
+    Blobs starting with the gzip magic are read as gzip, as written by
+    GzipTransformer.
+    """
+
+    SAMPLE_SIZE = 256 * 1024
+    POLICIES = ("fastest", "smallest", "balanced")
+
+    def __init__(self, nxt, codec="zlib", level=6, policy=None, bandwidth=1 << 20, benchmark_interval=20):
+        super(CompressionTransformer, self).__init__(bytes, bytes, nxt)
+        if policy is not None and policy not in self.POLICIES:
+            raise ValueError("Unknown compression policy %s" % policy)
+        self.codec = _CODECS_BY_NAME[codec]
+        self.level = level
+        self.policy = policy
+        self.bandwidth = bandwidth
+        self.benchmark_interval = benchmark_interval
+        self._stores = 0
+
+    def _benchmark(self, sample):
+        best = None
+        for codec in _CODECS:
+            for level in codec.levels:
+                start = time.perf_counter()
+                compressor = codec.compressor(level)
+                size = len(compressor.compress(sample)) + len(compressor.flush())
+                elapsed = time.perf_counter() - start
+                if self.policy == "fastest":
+                    score = elapsed
+                elif self.policy == "smallest":
+                    score = size
+                else:
+                    score = elapsed + size / self.bandwidth
+                if best is None or score < best[0]:
+                    best = score, codec, level
+        return best[1], best[2]
+
+    def load(self):
+        return b"".join(self.load_stream())
+
+    def store(self, obj):
+        self.store_stream((obj,))
+
+    def load_stream(self):
+        reader = _ChunkReader(self._nxt.load_stream())
+        header = reader.read(2)
+        if header == b"\x1f\x8b":
+            decompressor = zlib.decompressobj(31)
+            chunks = itertools.chain((header,), reader.rest())
+        else:
+            decompressor = _CODECS_BY_ID[header[0]].decompressor()
+            chunks = reader.rest()
+        measurement = Measurement("decompress")
+        try:
+            for chunk in chunks:
+                with measurement:
+                    data = decompressor.decompress(chunk)
+                measurement.bytes_in += len(chunk)
+                measurement.bytes_out += len(data)
+                if data:
+                    yield data
+            if hasattr(decompressor, "flush"):
+                with measurement:
+                    data = decompressor.flush()
+                measurement.bytes_out += len(data)
+                if data:
+                    yield data
+        finally:
+            measurement.record()
+
+    def store_stream(self, chunks):
+        chunks = iter(chunks)
+        if self.policy is not None:
+            if self._stores % self.benchmark_interval == 0:
+                # collect the sample without holding on to more than SAMPLE_SIZE
+                head = []
+                size = 0
+                for chunk in chunks:
+                    head.append(chunk)
+                    size += len(chunk)
+                    if size >= self.SAMPLE_SIZE:
+                        break
+                self.codec, self.level = self._benchmark(b"".join(head)[:self.SAMPLE_SIZE])
+                chunks = itertools.chain(head, chunks)
+            self._stores += 1
+        self._nxt.store_stream(self._compress(self.codec, self.level, chunks))
+
+    def _compress(self, codec, level, chunks):
+        # bytes_out / bytes_in of the "compress" event is the compression ratio
+        yield bytes((codec.codec_id, level))
+        compressor = codec.compressor(level)
+        measurement = Measurement("compress")
+        try:
+            for chunk in chunks:
+                with measurement:
+                    data = compressor.compress(chunk)
+                measurement.bytes_in += len(chunk)
+                measurement.bytes_out += len(data)
+                if data:
+                    yield data
+            with measurement:
+                data = compressor.flush()
+            measurement.bytes_out += len(data)
+            yield data
+        finally:
+            measurement.record()
+
 class LocalCopyStorageProvider(StorageProvider):
-    def __init__(self, upstream, local):
+    """
+    Mirrors upstream into local and falls back to the local copy when
+    upstream cannot be reached.
+
+    With revalidate, load returns the local copy right away and refreshes it
+    from upstream on a background thread, unless it was refreshed less than
+    refresh_interval seconds ago. If upstream had newer data, listener is
+    called and the next load returns the refreshed copy.
+
+    With a queue provider, stores that cannot reach upstream are kept in the
+    queue and retried every retry_interval seconds and on every refresh. If
+    upstream changed in the meantime, the local copy is replaced by the
+    upstream version, the queued data is moved to the queue file with a
+    .conflict suffix and listener is called so the changes can be merged.
+    A store that conflicts while upstream is reachable raises ConflictError
+    and drops the queue, the caller still has the changes.
+    """
+
+    def __init__(self, upstream, local, revalidate=False, queue=None, listener=None, retry_interval=30, refresh_interval=10):
         cl = upstream.input_type
         if local.input_type != cl:
             raise ValueError("Incompatible provider types %s vs %s" % (cl, local.input_type))
+        if queue is not None and queue.input_type != cl:
+            raise ValueError("Incompatible provider types %s vs %s" % (cl, queue.input_type))
         super(LocalCopyStorageProvider, self).__init__(cl)
         self.upstream = upstream
         self.local = local
+        self.queue = queue
+        self.revalidate = revalidate
+        self.listener = listener
+        self.retry_interval = retry_interval
+        self.refresh_interval = refresh_interval
         self.remote_success = True
 
+        self._lock = threading.RLock()
+        # time the local copy was last brought up to date with upstream
+        self._refreshed = 0
+        self._retry_thread = None
+
+    def _load_upstream(self):
+        with self._lock:
+            try:
+                self._flush()
+                val = self.upstream.load()
+                self.local.store(val)
+                self.remote_success = True
+                self._refreshed = time.time()
+                return val
+            except:
+                traceback.print_exc()
+                self.remote_success = False
+                return self.local.load()
+
     def load(self):
+        if not self.revalidate or not self.local.exists():
+            return self._load_upstream()
+        with self._lock:
+            val = self.local.load()
+            if time.time() - self._refreshed < self.refresh_interval:
+                return val
+        thr = threading.Thread(target=self._refresh)
+        thr.daemon = True
+        thr.start()
+        return val
+
+    def _refresh(self):
         try:
-            val = self.upstream.load()
-            self.local.store(val)
-            self.remote_success = True
-            return val
+            self.refresh()
         except:
             traceback.print_exc()
+
+    def refresh(self):
+        """
+        Brings the local copy up to date with upstream, flushing queued data
+        first. Calls listener if the local copy changed.
+        """
+        try:
+            with self._lock:
+                changed = self._flush()
+                val = self.upstream.load()
+                self.remote_success = True
+                self._refreshed = time.time()
+                if not self.local.exists() or val != self.local.load():
+                    self.local.store(val)
+                    changed = True
+        except:
             self.remote_success = False
-            return self.local.load()
+            raise
+        if changed and self.listener is not None:
+            self.listener()
+
+    def _pending(self):
+        return self.queue is not None and self.queue.exists()
+
+    def _flush(self):
+        """
+        Called with the lock held. Returns whether a conflict replaced the
+        local copy.
+        """
+        if not self._pending():
+            return False
+        try:
+            self.upstream.store(self.queue.load())
+            self.queue.delete()
+            return False
+        except ConflictError:
+            self._resolve_conflict(True)
+            return True
+
+    def _resolve_conflict(self, keep_queue):
+        val = self.upstream.load()
+        self.local.store(val)
+        if self._pending():
+            if keep_queue:
+                self.queue.rename(self.queue.filename + ".conflict")
+            else:
+                self.queue.delete()
+        self._refreshed = time.time()
+
+    def _retry(self):
+        while True:
+            time.sleep(self.retry_interval)
+            try:
+                with self._lock:
+                    conflict = self._flush()
+                    self.remote_success = True
+            except:
+                traceback.print_exc()
+                continue
+            finally:
+                if not self._pending():
+                    self._retry_thread = None
+            if conflict and self.listener is not None:
+                self.listener()
+            return
+
+    def store(self, obj):
+        self._store(lambda provider: provider.store(obj))
+
+    def store_stream(self, chunks):
+        # written to the local copy first, then read back from it in chunks
+        stored = [False]
+        def store(provider):
+            if not stored[0]:
+                provider.store_stream(chunks)
+                stored[0] = True
+            else:
+                provider.store_stream(self.local.load_stream())
+        self._store(store)
+
+    def _store(self, store):
+        with self._lock:
+            if self.queue is None:
+                if not self.remote_success:
+                    raise Exception("Remote load was not successful, not saving!")
+                store(self.local)
+                store(self.upstream)
+                return
+
+            store(self.local)
+            store(self.queue)
+            try:
+                store(self.upstream)
+                self.queue.delete()
+                self.remote_success = True
+            except ConflictError:
+                self._resolve_conflict(False)
+                raise
+            except:
+                traceback.print_exc()
+                self.remote_success = False
+                if self._retry_thread is None:
+                    self._retry_thread = threading.Thread(target=self._retry)
+                    self._retry_thread.daemon = True
+                    self._retry_thread.start()
+
+    def find(self, cl):
+        return self if isinstance(self, cl) else self.upstream.find(cl)
+
+    @property
+    def persistent(self):
+        return self.remote_success and not self._pending() and self.upstream.persistent
+
+class JournalStorageProvider(StorageProvider):
+    """
+    Keeps the vault as a snapshot (stored through the given dict pipeline)
+    plus a local append-only journal of single entry changes, so a save only
+    writes the entries that changed. Once the journal grows past
+    max_records or max_bytes it is compacted into a new snapshot on a
+    background thread.
+
+    The journal is local to this device. Records are replayed on top of the
+    snapshot on load; replaying a record that is already contained in the
+    snapshot is harmless, so a crash during compaction loses nothing.
+
+    Journal format, all integers big-endian:
+    00-04: record length (uint32)
+    04-..: record, encrypted by cipher
+
+    A decrypted record is the json of ["set", name, entry] or ["del", name].
+
+    The vault is only persistent once the journal is compacted into a
+    snapshot. If the snapshot changed on the server since it was loaded, a
+    background compaction fails with ConflictError and listener is called,
+    so the changes can be merged; the next store then stores a snapshot.
+    """
+
+    def __init__(self, snapshot, filename, cipher, max_records=256, max_bytes=1 << 20, listener=None):
+        if snapshot.input_type != dict:
+            raise ValueError("Snapshot provider must take %s, not %s" % (dict, snapshot.input_type))
+        super(JournalStorageProvider, self).__init__(dict)
+        self.snapshot = snapshot
+        self.filename = os.path.join(os.path.dirname(__file__), filename)
+        self.cipher = cipher
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.listener = listener
+
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._compact_thread = None
+        # copy of the last loaded or stored vault, to diff the next store against
+        self._known = None
+        self._records = 0
+        self._bytes = 0
+        # a compaction conflicted, the next store has to store a snapshot
+        self._conflict = False
+
+    def _read_journal(self):
+        try:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        pos = 0
+        while pos + 4 <= len(data):
+            length = struct.unpack(">I", data[pos:pos + 4])[0]
+            if pos + 4 + length > len(data):
+                # torn write at the end of the journal
+                break
+            yield json.loads(self.cipher.decrypt(data[pos + 4:pos + 4 + length]).decode("utf-8"))
+            pos += 4 + length
+
+    def load(self):
+        with self._lock:
+            obj = self.snapshot.load()
+            self._records = 0
+            for record in self._read_journal():
+                if record[0] == "set":
+                    obj["passwords"][record[1]] = record[2]
+                elif record[0] == "del":
+                    obj["passwords"].pop(record[1], None)
+                self._records += 1
+            self._bytes = os.path.getsize(self.filename) if self._records else 0
+            self._known = _copy_vault(obj)
+            return obj
 
     def store(self, obj):
-        if not self.remote_success:
-            raise Exception("Remote load was not successful, not saving!")
-        self.local.store(obj)
-        self.upstream.store(obj)
+        with self._lock:
+            known = self._known
+            if known is None or self._conflict or _vault_header(known) != _vault_header(obj):
+                # not expressible as entry changes, needs a full snapshot
+                self._known = _copy_vault(obj)
+                compact = False
+            else:
+                compact = self._append(known, obj)
+                if not compact:
+                    return
+                if self._compact_thread is None:
+                    self._compact_thread = threading.Thread(target=self._compact)
+                    self._compact_thread.daemon = True
+                    self._compact_thread.start()
+                return
+        try:
+            self._store_snapshot()
+        except:
+            with self._lock:
+                self._known = None
+            raise
+
+    def _append(self, known, obj):
+        # called with the lock held, returns whether the journal should be compacted
+        records = []
+        for name, entry in obj["passwords"].items():
+            if known["passwords"].get(name) != entry:
+                records.append(["set", name, entry])
+        for name in known["passwords"]:
+            if name not in obj["passwords"]:
+                records.append(["del", name])
+        if not records:
+            return False
+
+        buf = bytearray()
+        for record in records:
+            enc = self.cipher.encrypt(json.dumps(record).encode("utf-8"))
+            buf += struct.pack(">I", len(enc))
+            buf += enc
+        with open(self.filename, "ab") as f:
+            f.write(buf)
+        self._known = _copy_vault(obj)
+        self._records += len(records)
+        self._bytes += len(buf)
+        return self._records >= self.max_records or self._bytes >= self.max_bytes
+
+    def _store_snapshot(self):
+        with self._snapshot_lock:
+            with self._lock:
+                obj = _copy_vault(self._known)
+                length = self._bytes
+            self.snapshot.store(obj)
+            with self._lock:
+                self._conflict = False
+                self._truncate(length)
+
+    def _truncate(self, length):
+        # called with the lock held, drops the first length bytes of the
+        # journal and keeps the records appended since
+        try:
+            with open(self.filename, "rb") as f:
+                f.seek(length)
+                rest = f.read()
+        except FileNotFoundError:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(rest)
+        os.rename(tmp, self.filename)
+        self._bytes = len(rest)
+        self._records = sum(1 for _ in self._read_journal())
+
+    def _compact(self):
+        conflict = False
+        try:
+            self._store_snapshot()
+        except ConflictError:
+            with self._lock:
+                self._conflict = conflict = True
+        except:
+            traceback.print_exc()
+        finally:
+            self._compact_thread = None
+        if conflict and self.listener is not None:
+            self.listener()
+
+    def compact(self):
+        if self._known is not None:
+            self._store_snapshot()
+
+    def find(self, cl):
+        return self if isinstance(self, cl) else self.snapshot.find(cl)
+
+    def warm_up(self):
+        self.snapshot.warm_up()
 
     @property
     def persistent(self):
-        return self.remote_success and self.upstream.persistent
+        # journaled changes are only on this device
+        return self._records == 0 and self.snapshot.persistent
+
+def _vault_header(obj):
+    return { k: v for k, v in obj.items() if k != "passwords" }
+
+def _copy_vault(obj):
+    copy = dict(obj)
+    copy["passwords"] = { name: dict(entry) for name, entry in obj["passwords"].items() }
+    return copy
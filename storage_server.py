@@ -4,22 +4,33 @@ import storage
 import http.server
 import struct
 import Crypto.PublicKey.RSA
-import rsa
+import signing
 import os
 import scrypt
 import random
 import io
-import urllib.request
+import urllib.parse
+import http.client
 import traceback
-
-HASH = "SHA-512"
+import threading
+import collections
+import tempfile
+import concurrent.futures
+import contextlib
+import hmac
+import shutil
+import json
+import time
 
 def _readi(stream):
     return struct.unpack(">I", stream.read(4))[0]
 
 def _readblock(stream):
     block_length = _readi(stream)
-    return stream.read(block_length)
+    block = stream.read(block_length)
+    if len(block) != block_length:
+        raise struct.error("Block of %d bytes is truncated to %d" % (block_length, len(block)))
+    return block
 
 def _writei(stream, value):
     stream.write(struct.pack(">I", value))
@@ -28,102 +39,1022 @@ def _writeblock(stream, block):
     _writei(stream, len(block))
     stream.write(block)
 
+# seconds a server connection may be idle, or stall within a request,
+# before it is closed
+IDLE_TIMEOUT = 30
+
+# streamed stores of blobs up to this size are uploaded from memory, which
+# skips the upload if the blob did not change
+STREAM_THRESHOLD = 1 << 20
+
 class KeyExchange(storage.StorageTransformer):
+    """
+    Keeps the signing key pair of storage_provider in the vault.
+
+    A new vault needs a new key pair. warm_up generates it on a background
+    thread, so the first store does not have to wait for it.
+    """
+
     def __init__(self, nxt, storage_provider):
         super(KeyExchange, self).__init__(bytes, bytes, nxt)
         self.storage_provider = storage_provider
+        self._lock = threading.Lock()
+        self._keygen = None
+
+    def _load_keys(self, f):
+        self.storage_provider.private_key = signing.PrivateKey.load(_readblock(f))
+        self.storage_provider.public_key = signing.PublicKey.load(_readblock(f))
 
     def load(self):
         data = super(KeyExchange, self).load()
         f = io.BytesIO(data)
-        self.storage_provider.private_key = rsa.PrivateKey.load_pkcs1(_readblock(f), format="DER")
-        self.storage_provider.public_key = rsa.PublicKey.load_pkcs1(_readblock(f), format="DER")
+        self._load_keys(f)
         return _readblock(f)
 
-    def store(self, obj):
-        if self.storage_provider.private_key is None:
-            self.storage_provider.public_key, self.storage_provider.private_key = rsa.newkeys(2048)
+    def warm_up(self):
+        with self._lock:
+            if self.storage_provider.private_key is None and self._keygen is None:
+                self._keygen = concurrent.futures.Future()
+                thr = threading.Thread(target=self._generate_keys, args=(self._keygen,))
+                thr.daemon = True
+                thr.start()
+        super(KeyExchange, self).warm_up()
+
+    def _generate_keys(self, future):
+        try:
+            with storage.measure("keygen"):
+                future.set_result(signing.PrivateKey.generate())
+        except Exception as e:
+            future.set_exception(e)
+
+    def _ensure_keys(self):
+        if self.storage_provider.private_key is not None:
+            return
+        self.warm_up()
+        private_key = self._keygen.result()
+        with self._lock:
+            # a load may have brought the existing keys in the meantime
+            if self.storage_provider.private_key is None:
+                self.storage_provider.private_key = private_key
+                self.storage_provider.public_key = private_key.public_key
+            self._keygen = None
 
+    def store(self, obj):
+        self._ensure_keys()
         f = io.BytesIO()
-        _writeblock(f, self.storage_provider.private_key.save_pkcs1(format="DER"))
-        _writeblock(f, self.storage_provider.public_key.save_pkcs1(format="DER"))
-        _writeblock(f, obj)
-        super(KeyExchange, self).store(f.getvalue())
+        _writeblock(f, self.storage_provider.private_key.save())
+        _writeblock(f, self.storage_provider.public_key.save())
+        _writei(f, len(obj))
+        self._nxt.store_stream((f.getvalue(), obj))
+
+    def load_stream(self):
+        f = storage._ChunkReader(self._nxt.load_stream())
+        self._load_keys(f)
+        _readi(f)
+        return f.rest()
+
+class HttpError(IOError):
+    def __init__(self, status, reason):
+        super(HttpError, self).__init__("HTTP %d %s" % (status, reason))
+        self.status = status
+
+class CircuitOpenError(IOError):
+    pass
+
+class HttpTransport(object):
+    """
+    Keep-alive HTTP client for one server with a small connection pool.
+
+    Failed requests (connection errors and 5xx responses) are retried up to
+    retries times with jittered exponential backoff, as long as the deadline
+    for the whole request is not exceeded. After failure_threshold requests
+    in a row have failed, the circuit opens and requests fail immediately
+    until reset_timeout has passed, after which one request is let through
+    to probe the server.
+    """
+
+    def __init__(self, address, connect_timeout=3.0, read_timeout=10.0, deadline=15.0,
+                 retries=2, backoff=0.2, failure_threshold=3, reset_timeout=30.0, pool_size=4):
+        url = urllib.parse.urlsplit(address)
+        if url.scheme == "https":
+            self._connection_class = http.client.HTTPSConnection
+        else:
+            self._connection_class = http.client.HTTPConnection
+        self.host = url.netloc
+        self.base_path = url.path.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.pool_size = pool_size
+
+        self._lock = threading.Lock()
+        self._pool = []
+        self._failures = 0
+        self._open_until = 0
+
+    def _acquire(self, remaining):
+        with self._lock:
+            connection = self._pool.pop() if self._pool else None
+        if connection is None:
+            connection = self._connection_class(self.host, timeout=min(self.connect_timeout, remaining))
+            connection.connect()
+        connection.sock.settimeout(min(self.read_timeout, remaining))
+        return connection
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(connection)
+                return
+        connection.close()
+
+    def _check_circuit(self):
+        with self._lock:
+            now = time.time()
+            if self._failures >= self.failure_threshold:
+                if now < self._open_until:
+                    raise CircuitOpenError("Too many failed requests to %s, not trying again for %.0fs" % (self.host, self._open_until - now))
+                # half-open, let this request probe the server
+                self._open_until = now + self.reset_timeout
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self._failures = 0
+            else:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._open_until = time.time() + self.reset_timeout
+
+    def request(self, method, path="/", body=None, headers={}):
+        """
+        Returns (status, headers, body). Only raises HttpError for 5xx
+        responses, other status codes are left to the caller.
+        """
+
+        self._check_circuit()
+        end = time.time() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                result = self._request_once(method, path, body, headers, max(end - time.time(), 0.001))
+                if result[0] >= 500:
+                    raise HttpError(result[0], "from %s" % self.host)
+                self._record(True)
+                return result
+            except (OSError, http.client.HTTPException):
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                if attempt > self.retries or time.time() + delay >= end:
+                    self._record(False)
+                    raise
+                time.sleep(delay)
+
+    def _request_once(self, method, path, body, headers, remaining):
+        sent = len(body) if isinstance(body, bytes) else int(headers.get("Content-Length", 0))
+        with storage.measure("network", sent) as measurement:
+            connection = self._acquire(remaining)
+            if hasattr(body, "seek"):
+                # file bodies are read again on retries
+                body.seek(0)
+            try:
+                connection.request(method, self.base_path + path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except:
+                connection.close()
+                raise
+            measurement.bytes_out = len(data)
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return response.status, response.headers, data
+
+class FailoverTransport(object):
+    """
+    Sends each request to the first of several servers that takes it,
+    usually a primary followed by its replicas. A server is skipped when its
+    HttpTransport fails, and replicas are skipped for writes, which they
+    refuse with 421. List a replica first to read from it and still write
+    to the primary; RemoteStorageProvider ignores reads of versions older
+    than the last one it saw, so a lagging replica does not take it back.
+    """
+
+    def __init__(self, addresses, **options):
+        self.transports = [HttpTransport(address, **options) for address in addresses]
+        # servers that refused a write
+        self._read_only = set()
+
+    def request(self, method, path="/", body=None, headers={}):
+        error = None
+        result = None
+        for transport in self.transports:
+            if method != "GET" and transport in self._read_only:
+                continue
+            try:
+                result = transport.request(method, path, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+                continue
+            if result[0] != 421:
+                return result
+            self._read_only.add(transport)
+        if result is not None:
+            return result
+        if error is None:
+            raise IOError("No server takes %s requests" % method)
+        raise error
 
 class RemoteStorageProvider(storage.StorageProvider):
-    def __init__(self, address):
+    """
+    The ETag (version) of the last blob seen on the server is sent with every
+    store, which fails with ConflictError if the server has moved on since.
+
+    address is the server URL, or a list of URLs to fail over in order (see
+    FailoverTransport).
+
+    With multi_vault, the vault is at /vault/<fingerprint> on a server with
+    many vaults, named by the fingerprint of public_key once it is known.
+    Before that, e.g. when loading on a new device, fingerprint names the
+    vault, or else the vault of the cache file.
+
+    If cache_file is given, the last blob seen on the server is kept there
+    together with its ETag. Loads then only download the blob if it changed.
+
+    Cache file format:
+    block: ETag
+    block: blob
+    block: path of the vault on the server (missing in files written by
+           older versions, which are of /)
+    """
+
+    def __init__(self, address, cache_file=None, multi_vault=False, fingerprint=None, **transport_options):
         super(RemoteStorageProvider, self).__init__(bytes)
         self.address = address
+        if isinstance(address, str):
+            self.transport = HttpTransport(address, **transport_options)
+        else:
+            self.transport = FailoverTransport(address, **transport_options)
+        self.multi_vault = multi_vault
+        self.fingerprint = fingerprint
         self.private_key = None
         self.public_key = None
+        if cache_file is None:
+            self.cache_file = None
+        else:
+            self.cache_file = os.path.join(os.path.dirname(__file__), cache_file)
+        self._etag = None
+        self._cached = None
+        # path of the vault _etag and _cached are from
+        self._cached_path = None
+        self._read_cache()
+
+    def vault_path(self):
+        """
+        Path of the vault on the server.
+        """
+        if not self.multi_vault:
+            return "/"
+        if self.public_key is not None:
+            return "/vault/" + self.public_key.fingerprint
+        if self.fingerprint is not None:
+            return "/vault/" + self.fingerprint
+        if self._cached_path is not None and self._cached_path != "/":
+            return self._cached_path
+        raise IOError("Don't know which vault to load, set the fingerprint of its key")
+
+    def _read_cache(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file, "rb") as f:
+                self._etag = _readblock(f).decode("ascii")
+                self._cached = _readblock(f)
+                self._cached_path = _readblock(f).decode("ascii") if f.peek(1) else "/"
+        except (IOError, struct.error, UnicodeDecodeError):
+            self._etag = None
+            self._cached = None
+            self._cached_path = None
+
+    def _last_seen(self, path):
+        """
+        Returns the ETag and the blob last seen at path, None if unknown.
+        """
+        if self._cached_path != path:
+            return None, None
+        # after a streamed store the blob is only in the cache file
+        if self._cached is None and self._etag is not None:
+            self._read_cache()
+        return self._etag, self._cached
+
+    def _update_cache(self, path, etag, data):
+        self._etag = etag
+        self._cached = data
+        self._cached_path = path
+        if self.cache_file is None:
+            return
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "wb") as f:
+            _writeblock(f, etag.encode("ascii"))
+            _writeblock(f, data)
+            _writeblock(f, path.encode("ascii"))
+        os.rename(tmp, self.cache_file)
 
     def load(self):
-        return urllib.request.urlopen(self.address).read()
+        path = self.vault_path()
+        etag, cached = self._last_seen(path)
+        headers = {}
+        if cached is not None:
+            headers["If-None-Match"] = etag
+        status, response_headers, data = self.transport.request("GET", path, headers=headers)
+        if status == 304:
+            return cached
+        if status != 200:
+            raise HttpError(status, "loading from %s" % self.address)
+        new_etag = response_headers.get("ETag")
+        if new_etag is not None:
+            if cached is not None and _etag_version(new_etag) < _etag_version(etag):
+                # a replica that has not caught up yet
+                return cached
+            self._update_cache(path, new_etag, data)
+        return data
 
     def store(self, obj):
+        path = self.vault_path()
+        etag, cached = self._last_seen(path)
+        if cached == obj:
+            return
+
+        with storage.measure("sign", len(obj)):
+            signature = self.private_key.sign(obj)
+        headers = {}
+        if etag is not None:
+            headers["If-Match"] = etag
+
         f = io.BytesIO()
-        _writeblock(f, self.public_key.save_pkcs1(format="DER"))
-        _writeblock(f, rsa.sign(obj, self.private_key, HASH))
+        _writeblock(f, self.public_key.save())
+        _writeblock(f, signature)
         _writeblock(f, obj)
-        request = urllib.request.Request(self.address, data=f.getvalue(), method="PUT")
-        urllib.request.urlopen(request)
-
-def start_server(address, port, data_file):
-    if os.path.isfile(data_file):
-        with open(data_file) as f:
-            public_key = rsa.PublicKey.load_pkcs1(_readblock(f.buffer))
-            data = _readblock(f.buffer)
-    else:
-        public_key = None
-        data = None
-
-    def _save():
-        with open(data_file, "w") as f:
-            _writeblock(f.buffer, public_key.save_pkcs1())
-            _writeblock(f.buffer, data)
+        etag = self._put(path, f.getvalue(), headers)
+        if etag is not None:
+            self._update_cache(path, etag, obj)
 
-    class Handler(http.server.BaseHTTPRequestHandler):
-        def do_PUT(self):
+    def store_stream(self, chunks):
+        # the signature and the block length come before the data, so the
+        # request is spooled to disk and the header filled in afterwards
+        signature_length = self.private_key.signature_size
+        with tempfile.TemporaryFile() as f:
+            _writeblock(f, self.public_key.save())
+            _writei(f, signature_length)
+            header_end = f.tell()
+            f.write(bytes(signature_length + 4))
+            data_start = f.tell()
+            digest = signing.new_hash()
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+            length = f.tell() - data_start
+
+            if length <= STREAM_THRESHOLD:
+                f.seek(data_start)
+                self.store(f.read())
+                return
+
+            f.seek(header_end)
+            with storage.measure("sign", length):
+                signature = self.private_key.sign_hash(digest)
+            f.write(signature)
+            _writei(f, length)
+
+            path = self.vault_path()
+            etag, _ = self._last_seen(path)
+            headers = { "Content-Length": str(data_start + length) }
+            if etag is not None:
+                headers["If-Match"] = etag
+            etag = self._put(path, f, headers)
+            if etag is None:
+                return
+            self._etag = etag
+            self._cached = None
+            self._cached_path = path
+            if self.cache_file is not None:
+                f.seek(data_start)
+                tmp = self.cache_file + ".tmp"
+                with open(tmp, "wb") as cache:
+                    _writeblock(cache, etag.encode("ascii"))
+                    _writei(cache, length)
+                    shutil.copyfileobj(f, cache)
+                    _writeblock(cache, path.encode("ascii"))
+                os.rename(tmp, self.cache_file)
+
+    def _put(self, path, body, headers):
+        status, response_headers, _ = self.transport.request("PUT", path, body, headers)
+        if status in (409, 428):
+            raise storage.ConflictError("Vault was changed on the server since it was last loaded")
+        if status != 200:
+            raise HttpError(status, "storing to %s" % self.address)
+        return response_headers.get("ETag")
+
+def _etag_version(etag):
+    try:
+        return int(etag.strip('"'))
+    except ValueError:
+        return 0
+
+def _write_durably(path, payload):
+    # a temp file of its own, so writes to different paths never collide
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    with open(fd, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Persister(object):
+    """
+    Writes files atomically (temp file, fsync, rename) according to a
+    durability policy:
+
+    always:   every write is on disk before submit returns
+    grouped:  writes submitted within group_window of each other are
+              committed together, wait blocks until the batch is on disk
+    interval: the latest version of every file is committed every interval
+              seconds, wait does not block
+
+    Only the newest payload per path is written, older pending ones are
+    superseded. Commits run outside of the lock, so writes to different
+    paths don't wait for each other's fsync; submits to one path must be
+    serialized by the caller, as VaultStore does with its vault locks.
+    """
+
+    POLICIES = ("always", "grouped", "interval")
+
+    def __init__(self, policy="always", group_window=0.005, interval=1.0):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown durability policy %s" % policy)
+        self.policy = policy
+        self.group_window = group_window
+        self.interval = interval
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        # batch being written by the background thread
+        self._committing = {}
+        # generation of the batch currently being collected, and of the last committed one
+        self._generation = 1
+        self._committed = 0
+        self._error = None
+
+        self._writes = 0
+        self._commits = 0
+        self._files = 0
+        self._latencies = collections.deque(maxlen=1024)
+        self._commit_times = collections.deque(maxlen=1024)
+
+        if policy != "always":
+            thr = threading.Thread(target=self._run)
+            thr.daemon = True
+            thr.start()
+
+    def submit(self, path, payload):
+        """
+        Returns a ticket to pass to wait.
+        """
+        start = time.time()
+        if self.policy == "always":
+            self._commit({ path: payload })
+            with self._cond:
+                self._writes += 1
+                self._latencies.append(time.time() - start)
+            return None
+        with self._cond:
+            self._writes += 1
+            self._pending[path] = payload
+            self._cond.notify_all()
+            return self._generation, start
+
+    def wait(self, ticket):
+        if ticket is None:
+            return
+        generation, start = ticket
+        with self._cond:
+            if self.policy != "grouped":
+                self._latencies.append(time.time() - start)
+                return
+            while self._committed < generation:
+                self._cond.wait()
+            if self._error is not None and self._error[0] == generation:
+                raise IOError("Commit failed: %s" % self._error[1])
+            self._latencies.append(time.time() - start)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.group_window if self.policy == "grouped" else self.interval)
+            with self._cond:
+                batch = self._committing = self._pending
+                self._pending = {}
+                generation = self._generation
+                self._generation += 1
             try:
-                nonlocal public_key, data
+                self._commit(batch)
+            except Exception as e:
+                traceback.print_exc()
+                with self._cond:
+                    self._error = generation, e
+            with self._cond:
+                self._committing = {}
+                self._committed = generation
+                self._cond.notify_all()
 
-                r_public_key = rsa.PublicKey.load_pkcs1(_readblock(self.rfile), format="DER")
-                r_signature = _readblock(self.rfile)
-                r_message = _readblock(self.rfile)
+    def _commit(self, batch):
+        # called without the lock
+        start = time.time()
+        for path, payload in batch.items():
+            _write_durably(path, payload)
+        with self._cond:
+            self._commits += 1
+            self._files += len(batch)
+            self._commit_times.append(time.time() - start)
 
-                if public_key is not None and public_key != r_public_key:
-                    self.send_error(403)
+    def pending(self, path):
+        """
+        Returns the payload submitted for path that may not be on disk yet,
+        or None.
+        """
+        with self._cond:
+            payload = self._pending.get(path)
+            if payload is None:
+                payload = self._committing.get(path)
+            return payload
+
+    def flush(self):
+        with self._cond:
+            batch = self._pending
+            self._pending = {}
+        if batch:
+            self._commit(batch)
+
+    def metrics(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+            commit_times = list(self._commit_times)
+            return {
+                "policy": self.policy,
+                "writes": self._writes,
+                "commits": self._commits,
+                "files_per_commit": self._files / self._commits if self._commits else 0,
+                "commit_seconds_avg": sum(commit_times) / len(commit_times) if commit_times else 0,
+                "write_latency_p50": _percentile(latencies, 0.5),
+                "write_latency_p99": _percentile(latencies, 0.99),
+                "write_latency_max": latencies[-1] if latencies else 0,
+            }
+
+def _percentile(ordered, q):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class _Snapshot(collections.namedtuple("_Snapshot", ("public_key", "version", "data", "signature"))):
+    """
+    Immutable state of the vault. Writers replace the whole snapshot, so
+    readers never wait on a write and always see a consistent state.
+    """
+
+    @property
+    def etag(self):
+        return '"%d"' % self.version
+
+_EMPTY = _Snapshot(None, 0, None, None)
+
+class VaultStore(object):
+    """
+    The vaults of a server, each in its own data file. The vault named ""
+    is data_file, the others are addressed by the fingerprint of their
+    public key and live in a sharded layout under vault_dir:
+    <vault_dir>/<fingerprint[0:2]>/<fingerprint[2:4]>/<fingerprint>
+
+    Vaults are read when first used, and the snapshots of recently used
+    vaults are kept in memory up to cache_bytes of data.
+
+    Data file format:
+    block: PEM public key
+    block: blob
+    uint32: version (missing in files written by older versions)
+    block: signature of the blob (missing in files written by older versions)
+    """
+
+    def __init__(self, data_file, vault_dir, persister, cache_bytes=64 << 20):
+        self.data_file = data_file
+        self.vault_dir = vault_dir
+        self.persister = persister
+        self.cache_bytes = cache_bytes
+
+        self._cache_lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        # name -> [lock, users], only for vaults someone is waiting on
+        self._locks_lock = threading.Lock()
+        self._locks = {}
+
+    def path(self, name):
+        if name == "":
+            return self.data_file
+        return os.path.join(self.vault_dir, name[0:2], name[2:4], name)
+
+    @contextlib.contextmanager
+    def locked(self, name):
+        """
+        Serializes writes to one vault, writes to others don't wait.
+        """
+        with self._locks_lock:
+            entry = self._locks.get(name)
+            if entry is None:
+                entry = self._locks[name] = [threading.RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[name]
+
+    def get(self, name):
+        with self._cache_lock:
+            snapshot = self._cache.get(name)
+            if snapshot is not None:
+                self._cache.move_to_end(name)
+                self._hits += 1
+                return snapshot
+            self._misses += 1
+        with self.locked(name):
+            with self._cache_lock:
+                snapshot = self._cache.get(name)
+            if snapshot is None:
+                snapshot = self._read(name)
+                if snapshot.data is not None:
+                    self._remember(name, snapshot)
+            return snapshot
+
+    def _read(self, name):
+        # a write may not have reached the disk yet
+        payload = self.persister.pending(self.path(name))
+        if payload is None:
+            try:
+                with open(self.path(name), "rb") as f:
+                    payload = f.read()
+            except FileNotFoundError:
+                return _EMPTY
+        f = io.BytesIO(payload)
+        public_key = signing.PublicKey.load(_readblock(f))
+        data = _readblock(f)
+        version = _readi(f) if f.tell() < len(payload) else 1
+        signature = _readblock(f) if f.tell() < len(payload) else None
+        return _Snapshot(public_key, version, data, signature)
+
+    def put(self, name, snapshot):
+        """
+        Call with the vault locked. Returns the persister ticket.
+        """
+        path = self.path(name)
+        if name != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        ticket = self.persister.submit(path, _serialize(snapshot))
+        self._remember(name, snapshot)
+        return ticket
+
+    def _remember(self, name, snapshot):
+        with self._cache_lock:
+            old = self._cache.pop(name, None)
+            if old is not None:
+                self._cached_bytes -= len(old.data)
+            self._cache[name] = snapshot
+            self._cached_bytes += len(snapshot.data)
+            while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted.data)
+
+    def metrics(self):
+        with self._cache_lock:
+            return {
+                "cached_vaults": len(self._cache),
+                "cached_bytes": self._cached_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+def _serialize(snapshot):
+    f = io.BytesIO()
+    _writeblock(f, snapshot.public_key.save("PEM"))
+    _writeblock(f, snapshot.data)
+    _writei(f, snapshot.version)
+    _writeblock(f, snapshot.signature)
+    return f.getvalue()
+
+def _vault_name(path):
+    """
+    Returns the vault name for a request path, None if it addresses none.
+    """
+    path = urllib.parse.urlsplit(path).path
+    if path == "/":
+        return ""
+    if path.startswith("/vault/"):
+        name = path[len("/vault/"):].rstrip("/")
+        if len(name) == 64 and all(c in "0123456789abcdef" for c in name):
+            return name
+    return None
+
+class Replicator(object):
+    """
+    Sends the writes a primary accepted to one replica, in the background
+    and in order of the vaults changing. Only the newest version of a vault
+    is sent. A vault the replica did not take goes to the back of the queue
+    and is retried retry_interval seconds later, after the others.
+
+    Replication request: PUT to the vault path with the body of a client
+    store, the version in X-Replica-Version and token in
+    X-Replication-Token.
+    """
+
+    def __init__(self, address, token=None, retry_interval=1.0):
+        self.address = address
+        self.token = token
+        self.retry_interval = retry_interval
+        self.transport = HttpTransport(address)
+
+        self._cond = threading.Condition()
+        # name -> snapshot to send
+        self._pending = collections.OrderedDict()
+        self._sent = 0
+        self._failures = 0
+
+        thr = threading.Thread(target=self._run)
+        thr.daemon = True
+        thr.start()
+
+    def submit(self, name, snapshot):
+        with self._cond:
+            self._pending[name] = snapshot
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                name, snapshot = next(iter(self._pending.items()))
+            try:
+                self._send(name, snapshot)
+            except Exception:
+                traceback.print_exc()
+                with self._cond:
+                    self._failures += 1
+                    # a vault the replica refuses must not hold up the others
+                    if name in self._pending:
+                        self._pending.move_to_end(name)
+                time.sleep(self.retry_interval)
+                continue
+            with self._cond:
+                # a newer version may have come in meanwhile
+                if self._pending.get(name) is snapshot:
+                    del self._pending[name]
+                self._sent += 1
+
+    def _send(self, name, snapshot):
+        f = io.BytesIO()
+        _writeblock(f, snapshot.public_key.save())
+        _writeblock(f, snapshot.signature)
+        _writeblock(f, snapshot.data)
+        headers = { "X-Replica-Version": str(snapshot.version) }
+        if self.token is not None:
+            headers["X-Replication-Token"] = self.token
+        status, _, _ = self.transport.request("PUT", "/vault/" + name if name else "/", f.getvalue(), headers)
+        if status != 200:
+            raise HttpError(status, "replicating to %s" % self.address)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "address": self.address,
+                "pending": len(self._pending),
+                "sent": self._sent,
+                "failures": self._failures,
+            }
+
+def make_server(address, port, data_file, persister=None, vault_dir=None, cache_bytes=64 << 20,
+                replicate_to=(), replica=False, replication_token=None):
+    """
+    Serves the vault in data_file at /, and if vault_dir is given, any
+    number of vaults at /vault/<fingerprint>, where fingerprint is that of
+    the public key the vault is signed with (see signing.PublicKey). The
+    first key to store at / owns that vault.
+
+    Accepted writes are replicated to the servers in replicate_to. With
+    replica, clients can only read, writes come from the primary and are
+    only taken with replication_token, which a replica requires: the
+    version of a replicated write is not signed. A replica verifies the
+    signatures itself, it does not need to trust the primary otherwise.
+    """
+
+    if replica and replication_token is None:
+        raise ValueError("A replica needs a replication token")
+    if persister is None:
+        persister = Persister()
+    vaults = VaultStore(data_file, vault_dir, persister, cache_bytes)
+    replicators = [Replicator(url, replication_token) for url in replicate_to]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, without this the body
+        # waits for the delayed ack of the headers
+        disable_nagle_algorithm = True
+        # every connection has a thread, idle keep-alive connections must not keep it forever
+        timeout = IDLE_TIMEOUT
+
+        def _send_empty(self, code, etag=None):
+            self.send_response(code)
+            if etag is not None:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _vault(self):
+            name = _vault_name(self.path)
+            if name is None or (name != "" and vault_dir is None):
+                self.send_error(404)
+                return None
+            return name
+
+        def _read_put(self):
+            """
+            Returns the public key, signature and message of a PUT, None
+            after sending an error. Only Content-Length bytes are read, so
+            a malformed body cannot run into the next request.
+            """
+            try:
+                length = int(self.headers["Content-Length"])
+            except (KeyError, ValueError):
+                self.send_error(411)
+                return None
+            body = self.rfile.read(length)
+            f = io.BytesIO(body)
+            try:
+                r_public_key = signing.PublicKey.load(_readblock(f))
+                r_signature = _readblock(f)
+                r_message = _readblock(f)
+            except (struct.error, ValueError, IndexError, TypeError):
+                self.send_error(400)
+                return None
+            if len(body) != length or f.tell() != length:
+                self.send_error(400)
+                return None
+            return r_public_key, r_signature, r_message
+
+        def do_PUT(self):
+            try:
+                name = self._vault()
+                if name is None:
                     return
 
-                try:
-                    rsa.verify(r_message, r_signature, r_public_key)
-                except rsa.pkcs1.VerificationError:
+                request = self._read_put()
+                if request is None:
+                    return
+                r_public_key, r_signature, r_message = request
+                if name != "" and r_public_key.fingerprint != name:
                     self.send_error(403)
                     return
+                if self.headers.get("X-Replica-Version") is not None:
+                    self._replicate(name, r_public_key, r_signature, r_message)
+                    return
+                if replica:
+                    # clients write to the primary
+                    self.send_error(421)
+                    return
 
-                public_key = r_public_key
-                data = r_message
-                _save()
+                with vaults.locked(name):
+                    current = vaults.get(name)
+                    if current.public_key is not None and current.public_key != r_public_key:
+                        self.send_error(403)
+                        return
 
-                self.send_response(200)
-                self.end_headers()
+                    base = self.headers.get("If-Match")
+                    if current.data is not None:
+                        if base is None:
+                            self.send_error(428)
+                            return
+                        if base != current.etag:
+                            self.send_error(409)
+                            return
+
+                    with storage.measure("verify", len(r_message)):
+                        valid = r_public_key.verify(r_message, r_signature)
+                    if not valid:
+                        self.send_error(403)
+                        return
+
+                    new = _Snapshot(r_public_key, current.version + 1, r_message, r_signature)
+                    ticket = vaults.put(name, new)
+                    for replicator in replicators:
+                        replicator.submit(name, new)
+
+                # wait outside of the lock so concurrent writes end up in one commit
+                persister.wait(ticket)
+                self._send_empty(200, new.etag)
             except:
                 traceback.print_exc()
-                self.send_response(500)
-                self.end_headers()
+                self._send_empty(500)
+
+        def _replicate(self, name, public_key, signature, message):
+            token = self.headers.get("X-Replication-Token", "")
+            if not replica or not hmac.compare_digest(token, replication_token):
+                self.send_error(403)
+                return
+            version = int(self.headers["X-Replica-Version"])
+            with storage.measure("verify", len(message)):
+                valid = public_key.verify(message, signature)
+            if not valid:
+                self.send_error(403)
+                return
+
+            with vaults.locked(name):
+                current = vaults.get(name)
+                if current.public_key is not None and current.public_key != public_key:
+                    self.send_error(403)
+                    return
+                if version <= current.version:
+                    # already got this or a newer version
+                    self._send_empty(200, current.etag)
+                    return
+                new = _Snapshot(public_key, version, message, signature)
+                ticket = vaults.put(name, new)
+            persister.wait(ticket)
+            self._send_empty(200, new.etag)
 
         def do_GET(self):
-            if data is None:
+            if self.path == "/metrics":
+                body = json.dumps({
+                    "persistence": persister.metrics(),
+                    "cache": vaults.metrics(),
+                    "replication": [replicator.metrics() for replicator in replicators],
+                    "stats": storage.collector.stats() if storage.collector is not None else {},
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            name = self._vault()
+            if name is None:
+                return
+            current = vaults.get(name)
+            if current.data is None:
                 self.send_error(404)
                 return
 
+            if self.headers.get("If-None-Match") == current.etag:
+                self.send_response(304)
+                self.send_header("ETag", current.etag)
+                self.end_headers()
+                return
+
             self.send_response(200)
-            self.send_header("Content-Length", str(len(data)))
+            self.send_header("ETag", current.etag)
+            self.send_header("Content-Length", str(len(current.data)))
             self.end_headers()
 
-            self.wfile.write(data)
-    server = http.server.HTTPServer((address, port), Handler)
-    server.serve_forever()
+            self.wfile.write(current.data)
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def start_server(address, port, data_file, persister=None, vault_dir=None, cache_bytes=64 << 20,
+                 replicate_to=(), replica=False, replication_token=None):
+    if persister is None:
+        persister = Persister()
+    try:
+        make_server(address, port, data_file, persister, vault_dir, cache_bytes,
+                    replicate_to, replica, replication_token).serve_forever()
+    finally:
+        persister.flush()
 
 if __name__ == '__main__':
     import argparse
@@ -133,6 +1064,18 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--port", type=int, dest="port", required=True)
     parser.add_argument("-f", "--file", default=default_data_file, dest="data_file")
     parser.add_argument("--address", default="0.0.0.0", dest="address")
+    parser.add_argument("--vault-dir", dest="vault_dir", help="serve a vault per key at /vault/<fingerprint> from this directory")
+    parser.add_argument("--cache-size", type=int, default=64, dest="cache_size", help="MiB of vault data to keep in memory")
+    parser.add_argument("--replicate-to", default=[], action="append", dest="replicate_to", help="URL of a replica, may be repeated")
+    parser.add_argument("--replica", action="store_true", dest="replica", help="only take writes from a primary")
+    parser.add_argument("--replication-token", dest="replication_token", help="secret shared by a primary and its replicas, required with --replica")
+    parser.add_argument("--durability", default="always", choices=Persister.POLICIES, dest="durability")
+    parser.add_argument("--group-window", type=float, default=0.005, dest="group_window")
+    parser.add_argument("--interval", type=float, default=1.0, dest="interval")
     args = parser.parse_args()
+    if args.replica and args.replication_token is None:
+        parser.error("--replica requires --replication-token")
 
-    start_server(args.address, args.port, args.data_file)
+    persister = Persister(args.durability, args.group_window, args.interval)
+    start_server(args.address, args.port, args.data_file, persister, args.vault_dir, args.cache_size << 20,
+                 args.replicate_to, args.replica, args.replication_token)
@@ -12,6 +12,9 @@ ui.enabled = False
 
 client = local.Client()
 
+# maximum number of entries shown for a search, an empty one shows all
+SEARCH_LIMIT = 100
+
 def _finish_setup():
     ui.input.enabled = False
     ui.input.decorate = lambda text: "Loading..."
@@ -44,22 +47,28 @@ def launch(first=True):
         ui.input.enter = login
         return
 
-    if client.is_persistent():
-        prefix = "> "
-    else:
-        prefix = "! "
+    def prefix():
+        if client.has_pending_changes():
+            return "* "
+        elif client.is_persistent():
+            return "> "
+        else:
+            return "! "
     ui.input.enabled = True
-    ui.input.decorate = lambda text: prefix + text
+    ui.input.decorate = lambda text: prefix() + text
+    matches = {}
     def may_show(text):
-        text = text.lower()
-        search = ui.input.text.lower()
+        search = ui.input.text
         if len(search) > 0 and search[-1] == "~":
             search = search[:-1]
-        terms = search.split(" ")
-        for term in terms:
-            if term not in text:
-                return False
-        return True
+        if not search.strip():
+            # no filter, show every name like list_password_names
+            return True
+        if matches.get("query") != search:
+            # one index lookup in the server per query instead of matching every name here
+            matches["query"] = search
+            matches["names"] = set(client.search(search, SEARCH_LIMIT))
+        return text in matches["names"]
     ui.may_show = may_show
     for password in client.list_password_names():
         ui.add(password, True, "  " + password)